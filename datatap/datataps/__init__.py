@@ -23,11 +23,17 @@ Example usage::
     #comming soon:
     tap = S3DataTap(ZipFileDataTap(ModelDataTap([User.objects.filter(is_active=True), Group])))
     tap.send('exports/users.zip') #sends it to your s3 storage bucket
+    
+    #gzip a json fixture
+    tap = FileDataTap(CompressDataTap(JSONDataTap(ModelDataTap([ContentType])), codec='gzip'))
+    tap.send('fixtures.json.gz')
 
 '''
 from datatap.datataps.base import DataTap, FileTap
 from datatap.datataps.memory import MemoryDataTap
-from datatap.datataps.streams import StreamDataTap, BufferedStreamDataTap, FileDataTap, JSONDataTap
+from datatap.datataps.streams import (StreamDataTap, BufferedStreamDataTap, FileDataTap, JSONDataTap, NDJSONDataTap,
+                                     BinaryDataTap, ColumnarDataTap)
+from datatap.datataps.compress import CompressDataTap
 from datatap.datataps.zip import ZipFileDataTap
 from datatap.datataps.model import ModelDataTap
 try:
@@ -0,0 +1,316 @@
+import bz2
+import zlib
+from multiprocessing.pool import ThreadPool
+from optparse import Option
+
+from datatap.loading import register_datatap
+from datatap.datataps.streams import StreamDataTap
+
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+MAGIC_SIZE = 4
+
+
+class GzipCodec(object):
+    '''
+    Concatenated gzip members form a valid gzip file, so blocks may be
+    compressed independently
+    '''
+    magic = '\x1f\x8b'
+    default_level = 6
+    
+    def __init__(self, level=None, threads=None):
+        self.level = self.default_level if level is None else level
+        self.threads = threads
+    
+    def compressobj(self):
+        #wbits of 16 + 15 writes the gzip header and trailer
+        return zlib.compressobj(self.level, zlib.DEFLATED, 16 + 15)
+    
+    def decompressobj(self):
+        return zlib.decompressobj(16 + 15)
+    
+    def compress_block(self, data):
+        compressor = self.compressobj()
+        return compressor.compress(data) + compressor.flush()
+
+class BZ2Codec(GzipCodec):
+    magic = 'BZh'
+    default_level = 9
+    
+    def compressobj(self):
+        return bz2.BZ2Compressor(self.level)
+    
+    def decompressobj(self):
+        return bz2.BZ2Decompressor()
+
+class ZstdCodec(GzipCodec):
+    '''
+    Requires the zstandard package, which compresses on its own threads
+    '''
+    magic = '\x28\xb5\x2f\xfd'
+    default_level = 3
+    
+    def __init__(self, level=None, threads=None):
+        import zstandard
+        self.zstandard = zstandard
+        super(ZstdCodec, self).__init__(level, threads)
+    
+    def compressobj(self):
+        return self.zstandard.ZstdCompressor(level=self.level, threads=self.threads or 0).compressobj()
+    
+    def decompressobj(self):
+        return self.zstandard.ZstdDecompressor().decompressobj()
+    
+    def compress_block(self, data):
+        return self.zstandard.ZstdCompressor(level=self.level).compress(data)
+
+class LZ4Codec(GzipCodec):
+    '''
+    Requires the lz4 package, concatenated frames form a valid stream
+    '''
+    magic = '\x04\x22\x4d\x18'
+    default_level = 0
+    
+    def __init__(self, level=None, threads=None):
+        import lz4.frame
+        self.frame = lz4.frame
+        super(LZ4Codec, self).__init__(level, threads)
+    
+    def compressobj(self):
+        return LZ4Compressor(self.frame.LZ4FrameCompressor(compression_level=self.level))
+    
+    def decompressobj(self):
+        return self.frame.LZ4FrameDecompressor()
+    
+    def compress_block(self, data):
+        return self.frame.compress(data, compression_level=self.level)
+
+class LZ4Compressor(object):
+    '''
+    Gives the lz4 frame compressor the interface of zlib's
+    '''
+    def __init__(self, compressor):
+        self.compressor = compressor
+        self.started = False
+    
+    def compress(self, data):
+        if self.started:
+            return self.compressor.compress(data)
+        self.started = True
+        return self.compressor.begin() + self.compressor.compress(data)
+    
+    def flush(self):
+        return self.compress('') + self.compressor.flush()
+
+CODECS = {
+    'gzip': GzipCodec,
+    'bz2': BZ2Codec,
+    'zstd': ZstdCodec,
+    'lz4': LZ4Codec,
+}
+
+class ChunkedFile(object):
+    '''
+    A read only file object over an iterable of byte chunks
+    '''
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = ''
+    
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self.buffer + ''.join(self.chunks)
+            self.buffer = ''
+            return data
+        while len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+    
+    def __iter__(self):
+        if self.buffer:
+            yield self.buffer
+            self.buffer = ''
+        for chunk in self.chunks:
+            yield chunk
+
+class CompressDataTap(StreamDataTap):
+    '''
+    A stream data tap that compresses or decompresses the bytes of its instream
+    
+    CompressDT(JSONDT(ModelDT), codec='zstd') => zstd compressed json
+    JSONDT(CompressDT(FileDT(filename))) => json decompressed from filename
+    
+    Codecs are gzip, bz2 and, with their packages installed, zstd and lz4.
+    Unless `decompress` is given an instream of bytes with a read method, as
+    in a read chain, is decompressed and any other instream is compressed
+    with `codec` (gzip by default). A decompressed stream must start with the
+    magic bytes of `codec`, or of any codec when none is given, otherwise
+    ValueError is raised. Concatenated gzip members, bz2 streams and lz4
+    frames are all decompressed.
+    
+    With `threads` zstd compresses on that many threads of its own, the other
+    codecs compress blocks of `block_size` bytes on a pool of threads, each
+    block written as a member of its own.
+    '''
+    def __init__(self, instream=None, codec=None, level=None, threads=None, block_size=None, chunk_size=None,
+                 decompress=None, **kwargs):
+        '''
+        :param codec: One of gzip, bz2, zstd or lz4
+        :param level: The compression level of the codec
+        :param threads: The number of threads compressing at once
+        :param block_size: The number of bytes per block when compressing on threads
+        :param chunk_size: The number of bytes to read from the instream at a time
+        :param decompress: Decompress (True) or compress (False) the instream
+        '''
+        assert codec is None or codec in CODECS, 'Unrecognized codec: %s' % codec
+        self.codec_name = codec
+        self.level = level
+        self.threads = threads
+        self.block_size = block_size or DEFAULT_BLOCK_SIZE
+        self.chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+        self.decompress = decompress
+        super(CompressDataTap, self).__init__(instream, **kwargs)
+    
+    def get_codec(self, name):
+        return CODECS[name](level=self.level, threads=self.threads)
+    
+    def get_chunks(self, instream):
+        reader = getattr(instream, 'item_stream', instream)
+        if hasattr(reader, 'read'):
+            return iter(lambda: reader.read(self.chunk_size), '')
+        return (chunk.encode('utf-8') if isinstance(chunk, unicode) else chunk
+                for chunk in instream if chunk)
+    
+    def get_bytes_stream(self, instream):
+        decompress = self.decompress
+        if decompress is None:
+            #a read chain hands over a file like object of the stored bytes
+            decompress = hasattr(getattr(instream, 'item_stream', instream), 'read')
+        chunks = self.get_chunks(instream)
+        if decompress:
+            return ChunkedFile(self.process_decompress(chunks))
+        return ChunkedFile(self.process_compress(chunks))
+    
+    def process_compress(self, chunks):
+        codec_name = self.codec_name or 'gzip'
+        codec = self.get_codec(codec_name)
+        if self.threads and self.threads > 1 and codec_name != 'zstd':
+            return self.compress_blocks(codec, chunks)
+        return self.compress_stream(codec, chunks)
+    
+    def process_decompress(self, chunks):
+        first = ''
+        for chunk in chunks:
+            first += chunk
+            if len(first) >= MAGIC_SIZE:
+                break
+        codec_name = self.codec_name
+        if codec_name is None:
+            for name, codec in CODECS.items():
+                if first.startswith(codec.magic):
+                    codec_name = name
+                    break
+        if first and (codec_name is None or not first.startswith(CODECS[codec_name].magic)):
+            raise ValueError('Not a %s stream' % (codec_name or 'compressed'))
+        return self.decompress_stream(self.get_codec(codec_name or 'gzip'), self.prepend(first, chunks))
+    
+    def prepend(self, first, chunks):
+        if first:
+            yield first
+        for chunk in chunks:
+            yield chunk
+    
+    def compress_stream(self, codec, chunks):
+        compressor = codec.compressobj()
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    
+    def get_blocks(self, chunks):
+        block = list()
+        size = 0
+        for chunk in chunks:
+            block.append(chunk)
+            size += len(chunk)
+            if size >= self.block_size:
+                yield ''.join(block)
+                block = list()
+                size = 0
+        if block:
+            yield ''.join(block)
+    
+    def compress_blocks(self, codec, chunks):
+        '''
+        Compresses `threads` blocks at a time, zlib and bz2 release the GIL
+        '''
+        pool = ThreadPool(self.threads)
+        try:
+            blocks = self.get_blocks(chunks)
+            while True:
+                batch = [block for index, block in zip(range(self.threads), blocks)]
+                if not batch:
+                    break
+                for data in pool.map(codec.compress_block, batch):
+                    yield data
+        finally:
+            pool.terminate()
+    
+    def decompress_stream(self, codec, chunks):
+        decompressor = None
+        for chunk in chunks:
+            while chunk:
+                if decompressor is None:
+                    decompressor = codec.decompressobj()
+                try:
+                    data = decompressor.decompress(chunk)
+                except EOFError:
+                    #the previous member ended with the last chunk
+                    decompressor = None
+                    continue
+                if data:
+                    yield data
+                chunk = getattr(decompressor, 'unused_data', '')
+                if chunk or getattr(decompressor, 'eof', False):
+                    #a member ended, the rest belongs to the next one
+                    decompressor = None
+    
+    def send(self, fileobj):
+        for chunk in self.item_stream:
+            fileobj.write(chunk)
+    
+    command_option_list = [
+        Option('--codec', action='store', type='choice', choices=sorted(CODECS.keys()), dest='codec'),
+        Option('--level', action='store', type='int', dest='level',
+               help='The compression level of the codec'),
+        Option('--threads', action='store', type='int', dest='threads',
+               help='Compress on this many threads'),
+        Option('--block-size', action='store', type='int', dest='block_size',
+               help='The number of bytes per block when compressing on threads'),
+        Option('--decompress', action='store_true', dest='decompress', default=None,
+               help='Decompress the instream, the default when reading a stream of bytes'),
+        Option('--compress', action='store_false', dest='decompress',
+               help='Compress the instream, the default when writing'),
+    ]
+    
+    @classmethod
+    def get_command_arglist(cls, arglist):
+        #`Compress zstd` reads as `Compress --codec=zstd`
+        return ['--codec=%s' % arg if arg in CODECS else arg for arg in arglist]
+    
+    @classmethod
+    def load_from_command_line(cls, arglist, instream=None):
+        return super(CompressDataTap, cls).load_from_command_line(cls.get_command_arglist(arglist), instream)
+    
+    @classmethod
+    def load_from_command_line_for_write(cls, arglist, instream):
+        return super(CompressDataTap, cls).load_from_command_line_for_write(cls.get_command_arglist(arglist), instream)
+
+register_datatap('Compress', CompressDataTap)
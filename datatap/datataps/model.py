@@ -1,23 +1,763 @@
+import sys
+import time
+import hashlib
+import Queue
+import threading
+import tempfile
+import cPickle as pickle
 from optparse import OptionParser, Option
 from collections import deque
+try:
+    from collections import OrderedDict
+except ImportError: #python 2.6
+    from django.utils.datastructures import SortedDict as OrderedDict
 
-from django.db import models
+from itertools import islice
+from operator import attrgetter, itemgetter
+
+from django.conf import settings
+from django.db import models, connections, router, DEFAULT_DB_ALIAS
 from django.db import transaction
+from django.db.models import Q
+from django.db.models.sql.subqueries import DeleteQuery
+try:
+    from django.db.models.query import prefetch_related_objects
+except ImportError: #django 1.3
+    prefetch_related_objects = None
+from django.core.management.color import no_style
 from django.core.files import File
-from django.core.serializers.python import Serializer, Deserializer
-from django.utils.encoding import is_protected_type
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.serializers import base
+from django.core.serializers.python import Serializer, _get_model
+from django.utils.encoding import is_protected_type, smart_unicode
 
 from datatap.loading import register_datatap
+from datatap.utils import LRUCache
 from datatap.datataps.base import DataTap
 
 
+COMMIT_MODES = ('save', 'bulk', 'upsert')
+UPSERT_KEYS = ('pk', 'natural')
+COMMIT_POLICIES = ('object', 'all', 'count', 'time')
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_COMMIT_EVERY = {'count': 1000, 'time': 10}
+DEFAULT_NATURAL_KEY_CACHE_SIZE = 10000
+NATURAL_KEY_BATCH_SIZE = 500
+PREFETCH_BATCH_SIZE = 500
+LOOKUP_PARAMETERS = 900
+DEFAULT_EXPORT_BUFFER_SIZE = 1000
+DEFAULT_IMPORT_BUFFER_SIZE = 1000
+
+
+class NaturalKeyResolver(object):
+    '''
+    Resolves natural keys to model instances through an LRU cache. Missing
+    keys of a model can be prefetched with one query when the fields making
+    up its natural key can be worked out, otherwise `get_by_natural_key` is
+    called per key. Objects from the stream being deserialized are
+    registered, if a relation may refer to them by natural key, so that
+    references to objects that aren't saved yet can still be resolved. Their
+    natural keys, which may cost queries of their own, are only worked out
+    once a key of their model can't be found in the database.
+    '''
+    def __init__(self, cache_size=None):
+        self.cache = LRUCache(cache_size or DEFAULT_NATURAL_KEY_CACHE_SIZE)
+        self.lookup_fields = dict()
+        self.targets = get_natural_key_targets()
+        self.pending = dict()
+    
+    def register(self, obj):
+        model = type(obj)
+        if model not in self.targets:
+            return
+        if model not in self.pending:
+            self.pending[model] = deque(maxlen=self.cache.size)
+        self.pending[model].append(obj)
+    
+    def cache_pending(self, model):
+        '''
+        Caches the registered objects of a model under their natural keys
+        '''
+        for obj in self.pending.pop(model, []):
+            try:
+                natural_key = tuple(obj.natural_key())
+            except ObjectDoesNotExist:
+                #the natural key refers to a related object that isn't saved yet
+                continue
+            self.cache[(model, natural_key)] = obj
+    
+    def get_lookup_fields(self, model, natural_key):
+        '''
+        Works out the fields making up a model's natural key by resolving a
+        sample key and matching its parts against the object's field values.
+        Returns None if they cannot be told apart.
+        '''
+        if model not in self.lookup_fields:
+            try:
+                obj = self.resolve(model, natural_key)
+            except ObjectDoesNotExist:
+                return None
+            fields = list()
+            for part in natural_key:
+                matches = [field.attname for field in model._meta.fields
+                           if field.attname not in fields and getattr(obj, field.attname) == part]
+                if len(matches) != 1:
+                    fields = None
+                    break
+                fields.append(matches[0])
+            self.lookup_fields[model] = fields
+        return self.lookup_fields[model]
+    
+    def prefetch(self, model, natural_keys):
+        '''
+        Fetches the natural keys of a model that are not cached with one query
+        '''
+        missing = [natural_key for natural_key in set(natural_keys) if (model, natural_key) not in self.cache]
+        if not missing:
+            return
+        fields = self.get_lookup_fields(model, missing[0])
+        if not fields:
+            return
+        #keep clear of the query parameter limits of the backends
+        step = max(1, LOOKUP_PARAMETERS // len(fields))
+        for index in range(0, len(missing), step):
+            natural_keys = missing[index:index + step]
+            if len(fields) == 1:
+                query = Q(**{'%s__in' % fields[0]: [natural_key[0] for natural_key in natural_keys]})
+            else:
+                query = Q()
+                for natural_key in natural_keys:
+                    query |= Q(**dict(zip(fields, natural_key)))
+            for obj in model._default_manager.filter(query):
+                #only trust what the object reports as its natural key
+                self.cache[(model, tuple(obj.natural_key()))] = obj
+    
+    def resolve(self, model, natural_key):
+        natural_key = tuple(natural_key)
+        obj = self.cache.get((model, natural_key))
+        if obj is None:
+            try:
+                obj = model._default_manager.get_by_natural_key(*natural_key)
+            except ObjectDoesNotExist:
+                #it may be an object of the stream that isn't saved yet
+                self.cache_pending(model)
+                obj = self.cache.get((model, natural_key))
+                if obj is None:
+                    raise
+            self.cache[(model, natural_key)] = obj
+        return obj
+
+def get_natural_key_targets():
+    '''
+    Returns the models that foreign keys or many to many fields of the
+    installed models may refer to by natural key
+    '''
+    targets = set()
+    for model in models.get_models():
+        for field in model._meta.fields + model._meta.many_to_many:
+            if field.rel and hasattr(field.rel.to._default_manager, 'get_by_natural_key'):
+                targets.add(field.rel.to)
+    return targets
+
+def overrides(field, name):
+    return getattr(type(field), name).im_func is not getattr(models.Field, name).im_func
+
+def convert_value(value):
+    if isinstance(value, File) or is_protected_type(value):
+        return value
+    return smart_unicode(value)
+
+class SerializationPlan(object):
+    '''
+    The serialized fields of a model with their converters, worked out once
+    per model and reused for every row
+    
+    Each field is a tuple of (name, attname, convert, handle). Fields with a
+    `handle` are serialized from their instance, the rest convert the value
+    of their attname. `columns` lists the attnames to pull with values_list()
+    and is None when some field needs the instance.
+    '''
+    #django fields whose value_to_string only formats values that are not protected
+    row_safe_fields = (models.DateField, models.TimeField)
+    
+    def __init__(self, serializer, model):
+        self.label = smart_unicode(model._meta)
+        concrete_model = getattr(model._meta, 'concrete_model', None) or model
+        self.pk_attname = concrete_model._meta.pk.attname
+        self.fields = list()
+        row_safe = True
+        selected_fields = serializer.selected_fields
+        for field in concrete_model._meta.local_fields:
+            if not field.serialize:
+                continue
+            if field.rel is None:
+                if selected_fields is not None and field.attname not in selected_fields:
+                    continue
+                entry, field_row_safe = self.plan_field(serializer, field)
+            else:
+                if selected_fields is not None and field.attname[:-3] not in selected_fields:
+                    continue
+                entry, field_row_safe = self.plan_fk_field(serializer, field)
+            self.fields.append(entry)
+            row_safe = row_safe and field_row_safe
+        for field in concrete_model._meta.many_to_many:
+            if field.serialize and field.rel.through._meta.auto_created:
+                if selected_fields is None or field.attname in selected_fields:
+                    handle = lambda obj, field=field: serializer.get_m2m_value(obj, field)
+                    self.fields.append((field.name, None, None, handle))
+                    row_safe = False
+        if row_safe:
+            self.columns = [self.pk_attname] + [attname for name, attname, convert, handle in self.fields]
+        else:
+            self.columns = None
+    
+    def plan_field(self, serializer, field):
+        if isinstance(field, models.FileField):
+            return (field.name, field.attname, None, None), False
+        if overrides(field, '_get_val_from_obj') or overrides(field, 'value_to_string'):
+            def handle(obj, field=field):
+                value = field._get_val_from_obj(obj)
+                if isinstance(value, File) or is_protected_type(value):
+                    return value
+                return field.value_to_string(obj)
+            row_safe = (not overrides(field, '_get_val_from_obj') and
+                        type(field).__module__.startswith('django.') and
+                        isinstance(field, self.row_safe_fields))
+            return (field.name, field.attname, convert_value, handle), row_safe
+        #values of custom fields may be converted when set on the instance
+        row_safe = type(field).__module__.startswith('django.')
+        return (field.name, field.attname, convert_value, None), row_safe
+    
+    def plan_fk_field(self, serializer, field):
+        if serializer.use_natural_keys and hasattr(field.rel.to, 'natural_key'):
+            handle = lambda obj, field=field: serializer.get_fk_value(obj, field)
+            return (field.name, None, None, handle), False
+        return (field.name, field.attname, None, None), True
+    
+    def serialize_instance(self, obj):
+        fields = dict()
+        for name, attname, convert, handle in self.fields:
+            if handle is not None:
+                fields[name] = handle(obj)
+            elif convert is None:
+                fields[name] = getattr(obj, attname)
+            else:
+                fields[name] = convert(getattr(obj, attname))
+        return {
+            'model': self.label,
+            'pk': smart_unicode(getattr(obj, self.pk_attname), strings_only=True),
+            'fields': fields,
+        }
+    
+    def serialize_row(self, row):
+        '''
+        Serializes a values_list() row of `columns`
+        '''
+        fields = dict()
+        for (name, attname, convert, handle), value in zip(self.fields, islice(row, 1, None)):
+            if convert is None:
+                fields[name] = value
+            else:
+                fields[name] = convert(value)
+        return {
+            'model': self.label,
+            'pk': smart_unicode(row[0], strings_only=True),
+            'fields': fields,
+        }
+
 class FileAwareSerializer(Serializer):
+    def __init__(self, natural_key_cache=None):
+        '''
+        :param natural_key_cache: A mapping of (model, field name, value) to the natural key of the related object
+        '''
+        if natural_key_cache is None:
+            natural_key_cache = LRUCache(DEFAULT_NATURAL_KEY_CACHE_SIZE)
+        self.natural_key_cache = natural_key_cache
+    
+    def serialize(self, queryset, **options):
+        '''
+        Lazily serializes the queryset, yielding each primitive as soon as its
+        object has been handled
+        '''
+        self.start_options(options)
+        for obj in queryset:
+            yield self.get_plan(type(obj)).serialize_instance(obj)
+    
+    def serialize_rows(self, queryset, **options):
+        '''
+        Lazily serializes the queryset from values_list() rows without
+        building model instances. Models with fields that need their
+        instances are serialized from instances instead.
+        '''
+        self.start_options(options)
+        plan = self.get_plan(queryset.model)
+        if plan.columns is None:
+            for obj in queryset.iterator():
+                yield plan.serialize_instance(obj)
+            return
+        for row in queryset.values_list(*plan.columns).iterator():
+            yield plan.serialize_row(row)
+    
+    def start_options(self, options):
+        self.options = options
+        self.selected_fields = options.pop('fields', None)
+        self.use_natural_keys = options.pop('use_natural_keys', False)
+        self.plans = dict()
+    
+    def get_plan(self, model):
+        plan = self.plans.get(model)
+        if plan is None:
+            plan = self.plans[model] = SerializationPlan(self, model)
+        return plan
+    
     def handle_field(self, obj, field):
         value = field._get_val_from_obj(obj)
         if isinstance(value, File) or is_protected_type(value):
             self._current[field.name] = value
         else:
             self._current[field.name] = field.value_to_string(obj)
+    
+    def get_natural_key(self, model, field_name, value, get_related):
+        key = (model, field_name, value)
+        natural_key = self.natural_key_cache.get(key)
+        if natural_key is None:
+            natural_key = get_related().natural_key()
+            self.natural_key_cache[key] = natural_key
+        return natural_key
+    
+    def get_fk_value(self, obj, field):
+        value = getattr(obj, field.get_attname())
+        if value is not None:
+            #repeated targets are answered without loading the related object
+            value = self.get_natural_key(field.rel.to, field.rel.field_name, value,
+                                         lambda: getattr(obj, field.name))
+        return value
+    
+    def handle_fk_field(self, obj, field):
+        if self.use_natural_keys and hasattr(field.rel.to, 'natural_key'):
+            self._current[field.name] = self.get_fk_value(obj, field)
+        else:
+            super(FileAwareSerializer, self).handle_fk_field(obj, field)
+    
+    def get_m2m_value(self, obj, field):
+        #all() rather than iterator() so prefetched objects are used
+        related_objects = getattr(obj, field.name).all()
+        if self.use_natural_keys and hasattr(field.rel.to, 'natural_key'):
+            pk_name = field.rel.to._meta.pk.name
+            return [self.get_natural_key(field.rel.to, pk_name, related._get_pk_val(), lambda: related)
+                    for related in related_objects]
+        return [smart_unicode(related._get_pk_val(), strings_only=True)
+                for related in related_objects]
+    
+    def handle_m2m_field(self, obj, field):
+        if field.rel.through._meta.auto_created:
+            self._current[field.name] = self.get_m2m_value(obj, field)
+
+class UncommittedJournal(object):
+    '''
+    A first in, first out queue of deserialized objects that keeps up to
+    `limit` objects in memory and pickles the rest to a temporary file.
+    File fields are journaled as their names, which is all a raw save stores.
+    '''
+    def __init__(self, limit):
+        self.limit = limit
+        self.objects = deque()
+        self.journal = None
+        self.read_position = 0
+        self.write_position = 0
+        self.journaled = 0
+    
+    def __len__(self):
+        return len(self.objects) + self.journaled
+    
+    def __nonzero__(self):
+        return bool(len(self))
+    
+    def append(self, deserialized):
+        if not self.journaled and len(self.objects) < self.limit:
+            self.objects.append(deserialized)
+            return
+        if self.journal is None:
+            self.journal = tempfile.TemporaryFile()
+        instance = deserialized.object
+        for field in instance._meta.fields:
+            if isinstance(field, models.FileField):
+                #the file descriptor swaps in a picklable FieldFile
+                getattr(instance, field.attname)
+        self.journal.seek(self.write_position)
+        pickle.dump(deserialized, self.journal, pickle.HIGHEST_PROTOCOL)
+        self.write_position = self.journal.tell()
+        self.journaled += 1
+    
+    def popleft(self):
+        if self.objects:
+            return self.objects.popleft()
+        if not self.journaled:
+            raise IndexError('pop from an empty journal')
+        self.journal.seek(self.read_position)
+        deserialized = pickle.load(self.journal)
+        self.read_position = self.journal.tell()
+        self.journaled -= 1
+        if not self.journaled:
+            self.journal.close()
+            self.journal = None
+            self.read_position = self.write_position = 0
+        return deserialized
+
+def get_source_model(source):
+    try:
+        if issubclass(source, models.Model):
+            return source
+    except TypeError:
+        pass
+    if isinstance(source, models.Model):
+        return type(source)
+    return getattr(source, 'model', None)
+
+def get_model_dependencies(model):
+    '''
+    Returns the models whose rows the rows of `model` refer to
+    '''
+    opts = (getattr(model._meta, 'concrete_model', None) or model)._meta
+    dependencies = set()
+    for field in opts.local_fields:
+        if field.rel:
+            dependencies.add(field.rel.to)
+    for field in opts.many_to_many:
+        if field.rel.through._meta.auto_created:
+            dependencies.add(field.rel.to)
+    dependencies.discard(model)
+    return dependencies
+
+def sort_sources(sources):
+    '''
+    Orders model sources so that the targets of foreign keys come before the
+    sources referring to them, otherwise keeping the given order
+    '''
+    pending = list(sources)
+    ordered = list()
+    while pending:
+        pending_models = set(get_source_model(source) for source in pending)
+        for index, source in enumerate(pending):
+            model = get_source_model(source)
+            if model is None or not (get_model_dependencies(model) & pending_models):
+                break
+        else:
+            index = 0 #circular references keep their order
+        ordered.append(pending.pop(index))
+    return ordered
+
+def get_shared_connections():
+    '''
+    In memory sqlite databases only exist on their connection, which is
+    shared with the worker threads
+    '''
+    shared = dict()
+    for alias in connections:
+        connection = connections[alias]
+        if (connection.settings_dict['ENGINE'] == 'django.db.backends.sqlite3' and
+            connection.settings_dict['NAME'] == ':memory:'):
+            shared[alias] = connection
+    return shared
+
+class ParallelExport(object):
+    '''
+    Serializes model sources on `workers` threads, each with its own database
+    connection, and yields their primitives in the order of the sources. At
+    most `buffer_size` primitives of a source wait to be merged.
+    '''
+    def __init__(self, datatap, sources, workers, buffer_size=None):
+        self.datatap = datatap
+        self.sources = list(sources)
+        self.workers = workers
+        self.buffer_size = buffer_size or DEFAULT_EXPORT_BUFFER_SIZE
+        self.tasks = Queue.Queue()
+        self.outputs = list()
+        for index, source in enumerate(self.sources):
+            self.tasks.put(index)
+            self.outputs.append(Queue.Queue(maxsize=self.buffer_size))
+        self.stopped = threading.Event()
+        self.threads = list()
+        self.shared_connections = dict()
+    
+    def __iter__(self):
+        self.start()
+        try:
+            for output in self.outputs:
+                while True:
+                    kind, value = output.get()
+                    if kind == 'item':
+                        yield value
+                    elif kind == 'error':
+                        raise value[0], value[1], value[2]
+                    else:
+                        break
+        finally:
+            self.stop()
+    
+    def start(self):
+        self.shared_connections = get_shared_connections()
+        for connection in self.shared_connections.values():
+            connection.allow_thread_sharing = True
+        for i in range(min(self.workers, len(self.sources))):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+    
+    def stop(self):
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = list()
+        for connection in self.shared_connections.values():
+            connection.allow_thread_sharing = False
+    
+    def put(self, output, message):
+        #gives up once the merge has stopped reading
+        while not self.stopped.is_set():
+            try:
+                output.put(message, timeout=.1)
+            except Queue.Full:
+                continue
+            return True
+        return False
+    
+    def work(self):
+        for alias, connection in self.shared_connections.items():
+            connections[alias] = connection
+        try:
+            while not self.stopped.is_set():
+                try:
+                    index = self.tasks.get_nowait()
+                except Queue.Empty:
+                    return
+                output = self.outputs[index]
+                try:
+                    for item in self.datatap.get_serial_primitive_stream([self.sources[index]]):
+                        if not self.put(output, ('item', item)):
+                            return
+                except Exception:
+                    self.put(output, ('error', sys.exc_info()))
+                    return
+                self.put(output, ('done', None))
+        finally:
+            for alias in connections:
+                if alias not in self.shared_connections:
+                    connections[alias].close()
+
+class ParallelImport(object):
+    '''
+    Saves the deserialized objects of each model on up to `workers` threads,
+    each with its own database connection and transactions. A model is saved
+    once the models it refers to have been saved. The stream is read first,
+    each model keeping up to `uncommitted_limit` objects in memory and
+    journaling the rest to disk.
+    '''
+    def __init__(self, datatap, deserialized_objects, workers):
+        self.datatap = datatap
+        self.groups = OrderedDict()
+        buffer_size = datatap.uncommitted_limit or DEFAULT_IMPORT_BUFFER_SIZE
+        for deserialized in deserialized_objects:
+            model = type(deserialized.object)
+            if model not in self.groups:
+                self.groups[model] = UncommittedJournal(buffer_size)
+            self.groups[model].append(deserialized)
+        self.dependencies = dict()
+        for model in self.groups:
+            self.dependencies[model] = get_model_dependencies(model) & set(self.groups)
+        self.shared_connections = get_shared_connections()
+        #threads cannot run transactions concurrently on a shared connection
+        self.workers = 1 if self.shared_connections else workers
+        self.pending = list(self.groups)
+        self.running = set()
+        self.done = set()
+        self.errors = list()
+        self.threads = list()
+        self.condition = threading.Condition()
+    
+    def next_model(self):
+        for model in self.pending:
+            if self.dependencies[model] <= self.done:
+                return model
+        if self.pending and not self.running:
+            return self.pending[0] #circular references keep their order
+        return None
+    
+    def run(self):
+        for connection in self.shared_connections.values():
+            connection.allow_thread_sharing = True
+        try:
+            with self.condition:
+                while (self.pending and not self.errors) or self.running:
+                    model = None
+                    if not self.errors and len(self.running) < self.workers:
+                        model = self.next_model()
+                    if model is None:
+                        self.condition.wait()
+                        continue
+                    self.pending.remove(model)
+                    self.running.add(model)
+                    thread = threading.Thread(target=self.save_model, args=(model,))
+                    thread.daemon = True
+                    thread.start()
+                    self.threads.append(thread)
+            for thread in self.threads:
+                thread.join()
+        finally:
+            for connection in self.shared_connections.values():
+                connection.allow_thread_sharing = False
+        if self.errors:
+            error = self.errors[0]
+            raise error[0], error[1], error[2]
+    
+    def get_group_stream(self, model):
+        queue = self.groups[model]
+        while queue:
+            yield queue.popleft()
+    
+    def save_model(self, model):
+        for alias, connection in self.shared_connections.items():
+            connections[alias] = connection
+        try:
+            self.datatap.commit_stream(self.get_group_stream(model))
+        except Exception:
+            with self.condition:
+                self.errors.append(sys.exc_info())
+        finally:
+            for alias in connections:
+                if alias not in self.shared_connections:
+                    connections[alias].close()
+            with self.condition:
+                self.running.discard(model)
+                self.done.add(model)
+                self.condition.notify()
+
+def get_natural_key_fields(model):
+    '''
+    Returns the fields of the unique constraint backing a model's natural
+    key, taken to be its first unique_together or unique field
+    '''
+    opts = model._meta
+    if not hasattr(model, 'natural_key'):
+        return None
+    for names in opts.unique_together:
+        return [opts.get_field(name) for name in names]
+    for field in opts.local_fields:
+        if field.unique and not field.primary_key:
+            return [field]
+    return None
+
+class UpsertQuery(object):
+    '''
+    Inserts rows of a model, updating the rows whose key already exists, with
+    the backend's native upsert. The key is the primary key or the fields of
+    the model's natural key, in which case an automatic primary key is left
+    to the database.
+    '''
+    def __init__(self, model, connection, key='pk'):
+        opts = model._meta
+        self.model = model
+        self.connection = connection
+        self.key_fields = None
+        if key == 'natural':
+            self.key_fields = get_natural_key_fields(model)
+        if not self.key_fields:
+            self.key_fields = [opts.pk]
+        self.fields = [field for field in opts.local_fields
+                       if field is not opts.pk or field in self.key_fields or not isinstance(field, models.AutoField)]
+        self.update_fields = [field for field in self.fields
+                              if field is not opts.pk and field not in self.key_fields]
+    
+    @classmethod
+    def is_supported(cls, connection):
+        if connection.vendor == 'sqlite':
+            from django.db.backends.sqlite3.base import Database
+            return Database.sqlite_version_info >= (3, 24)
+        if connection.vendor == 'postgresql':
+            return getattr(connection, 'pg_version', 0) >= 90500
+        return connection.vendor == 'mysql'
+    
+    def has_other_unique_keys(self):
+        '''
+        MySQL updates the row matching any unique index, so the upsert cannot
+        be keyed on `key_fields` if another unique constraint is inserted
+        '''
+        if self.connection.vendor != 'mysql':
+            return False
+        opts = self.model._meta
+        key_names = set(field.name for field in self.key_fields)
+        inserted_names = set(field.name for field in self.fields)
+        unique_sets = [set([field.name]) for field in self.fields if field.unique]
+        unique_sets.extend(set(names) for names in opts.unique_together)
+        for names in unique_sets:
+            if names != key_names and names <= inserted_names:
+                return True
+        return False
+    
+    def get_sql(self, num_rows):
+        qn = self.connection.ops.quote_name
+        row = '(%s)' % ', '.join(['%s'] * len(self.fields))
+        sql = 'INSERT INTO %s (%s) VALUES %s' % (
+            qn(self.model._meta.db_table),
+            ', '.join(qn(field.column) for field in self.fields),
+            ', '.join([row] * num_rows))
+        if self.connection.vendor == 'mysql':
+            #an update of the key to itself stands in for doing nothing
+            update_fields = self.update_fields or self.key_fields[:1]
+            return '%s ON DUPLICATE KEY UPDATE %s' % (sql, ', '.join(
+                '%s = VALUES(%s)' % (qn(field.column), qn(field.column)) for field in update_fields))
+        conflict = ', '.join(qn(field.column) for field in self.key_fields)
+        if not self.update_fields:
+            return '%s ON CONFLICT (%s) DO NOTHING' % (sql, conflict)
+        return '%s ON CONFLICT (%s) DO UPDATE SET %s' % (sql, conflict, ', '.join(
+            '%s = EXCLUDED.%s' % (qn(field.column), qn(field.column)) for field in self.update_fields))
+    
+    def get_key(self, obj):
+        return tuple(getattr(obj, field.attname) for field in self.key_fields)
+    
+    def get_content_hash(self, values):
+        values = [field.get_db_prep_save(value, connection=self.connection)
+                  for field, value in zip(self.update_fields, values)]
+        return hashlib.md5(repr(values)).hexdigest()
+    
+    def get_changed(self, objs):
+        '''
+        Returns the objects whose row is missing or differs, comparing content
+        hashes of the updated fields with one query
+        '''
+        keys = [self.get_key(obj) for obj in objs]
+        attnames = [field.attname for field in self.key_fields]
+        if len(attnames) == 1:
+            query = Q(**{'%s__in' % attnames[0]: [key[0] for key in keys]})
+        else:
+            query = Q()
+            for key in keys:
+                query |= Q(**dict(zip(attnames, key)))
+        rows = self.model._base_manager.using(self.connection.alias).filter(query).values_list(
+            *(attnames + [field.attname for field in self.update_fields]))
+        hashes = dict((tuple(row[:len(attnames)]), self.get_content_hash(row[len(attnames):])) for row in rows)
+        return [obj for obj, key in zip(objs, keys)
+                if hashes.get(key) != self.get_content_hash([getattr(obj, field.attname) for field in self.update_fields])]
+    
+    def execute(self, objs):
+        #a statement may not touch the same row twice, the last object wins
+        unique = OrderedDict()
+        for obj in objs:
+            key = self.get_key(obj)
+            unique.pop(key, None)
+            unique[key] = obj
+        objs = list(unique.values())
+        step = max(1, self.connection.ops.bulk_batch_size(self.fields, objs))
+        cursor = self.connection.cursor()
+        for index in range(0, len(objs), step):
+            chunk = objs[index:index + step]
+            params = list()
+            for obj in chunk:
+                params.extend(field.get_db_prep_save(getattr(obj, field.attname), connection=self.connection)
+                              for field in self.fields)
+            cursor.execute(self.get_sql(len(chunk)), params)
+        transaction.set_dirty(using=self.connection.alias)
 
 class ModelDataTap(DataTap):
     '''
@@ -26,13 +766,112 @@ class ModelDataTap(DataTap):
     ModelDT([MyModel, Queryset, ModelInstance]) => primitive representation of sources
     ModelDT(ZipDT(...)) => deserialized objects from the zip datatap
     ModelDT(ZipDT(...)).commit() => save the deserialized objects
+    
+    With `commit_mode="bulk"` consecutive objects of the same model are
+    inserted with `bulk_create` in batches of `batch_size`, one transaction
+    per batch. Bulk inserts do not update existing rows. Objects with m2m data
+    and models with file, auto_now or inherited fields are saved one by one.
+    
+    `commit_mode="upsert"` batches the same objects into the backend's native
+    upsert (sqlite 3.24+, PostgreSQL 9.5+ and MySQL) keyed on `upsert_key`,
+    either the primary key ("pk") or the unique fields behind the model's
+    natural key ("natural"). Other backends save the objects one by one, as
+    does MySQL for models with a unique constraint besides the key, since its
+    ON DUPLICATE KEY UPDATE updates whichever row any unique index matches.
+    Objects saved one by one, including those with m2m data, are matched to
+    the stored row by the same key. With `skip_unchanged` rows whose content hash matches the stored row are
+    skipped and counted in `skipped_count`.
+    
+    `commit_policy` sets the transaction boundaries of `commit`:
+    
+    * object: commit after every object or bulk batch (default)
+    * all: a single transaction, any failure rolls back everything (default
+      with `fast_load`, which allows no other)
+    * count: commit every `commit_every` objects
+    * time: commit every `commit_every` seconds
+    
+    With count and time every object or batch is saved within a savepoint,
+    a failing row is rolled back, logged and skipped without discarding the
+    rest of the transaction.
+    
+    Iterating the tap tracks the deserialized objects for a later `commit`.
+    `uncommitted_limit` bounds how many are held in memory, past which
+    `uncommitted_overflow` either flushes them to the database ("flush") or
+    spools them to a temporary journal that `commit` replays ("spool").
+    Flushing commits while the tap is iterated, so `commit_policy="all"`
+    (and with it `fast_load`) requires spooling.
+    
+    With `chunk_size` models and querysets are exported in primary key order,
+    `chunk_size` rows per query. The last key exported for each model is kept
+    in `last_keys` and passing it back as `resume_keys` resumes the export.
+    
+    Exports with natural keys select the related objects whose natural keys
+    are serialized and prefetch many to many relations, in batches of
+    instances when the export is not chunked. Natural keys are cached per
+    export, up to `natural_key_cache_size` related objects. Imports resolve
+    natural keys through a cache of the same size, batching the lookups.
+    
+    With `raw_export` models and querysets are exported from values_list()
+    rows without building model instances. Models with fields that need their
+    instances (file fields, natural keys, many to many) are exported from
+    instances as usual, the primitives are the same either way.
+    
+    With more than one of `workers` each model source is exported on its own
+    thread and database connection. Sources are ordered so that the targets
+    of foreign keys come first and their primitives are merged in that order.
+    On `commit` the objects of up to `workers` models are saved concurrently,
+    each model on its own connection and transactions once the models it
+    refers to have been saved. The whole stream is read before saving starts,
+    past `uncommitted_limit` objects of a model (1000 by default) the rest
+    are journaled to disk. As every model commits on its own a failure
+    leaves the models already saved, so `commit_policy="all"` requires a
+    single worker.
+    
+    With `fast_load` objects are saved raw without sending model or m2m
+    signals. Foreign key checks are disabled or deferred, as the backend
+    allows, while the stream is saved and verified once for the saved tables
+    before the sequences are reset and the single transaction is committed,
+    so no row is stored if any is invalid. Django 1.3 cannot disable the
+    checks and verifies rows as they are saved instead.
     '''
-    def __init__(self, instream=None, use_natural_keys=True, track_uncommitted=True, **kwargs):
+    def __init__(self, instream=None, use_natural_keys=True, track_uncommitted=True, commit_mode='save', batch_size=None,
+                 commit_policy=None, commit_every=None, uncommitted_limit=None, uncommitted_overflow='flush',
+                 chunk_size=None, resume_keys=None, natural_key_cache_size=None, raw_export=False,
+                 workers=None, fast_load=False, upsert_key='pk', skip_unchanged=False, **kwargs):
+        if commit_policy is None:
+            commit_policy = 'all' if fast_load else 'object'
+        assert commit_mode in COMMIT_MODES, 'Unrecognized commit mode: %s' % commit_mode
+        assert commit_policy in COMMIT_POLICIES, 'Unrecognized commit policy: %s' % commit_policy
+        assert upsert_key in UPSERT_KEYS, 'Unrecognized upsert key: %s' % upsert_key
+        assert not (workers > 1 and commit_policy == 'all'), 'Each worker commits on its own, commit_policy="all" needs one worker'
+        assert not fast_load or commit_policy == 'all', 'Constraints are checked once, fast_load needs commit_policy="all"'
+        assert not (commit_policy == 'all' and uncommitted_limit and uncommitted_overflow == 'flush'), \
+            'Flushing commits, commit_policy="all" needs uncommitted_overflow="spool"'
         self.use_natural_keys = use_natural_keys
+        self.commit_mode = commit_mode
+        self.batch_size = batch_size or DEFAULT_BATCH_SIZE
+        self.commit_policy = commit_policy
+        self.commit_every = commit_every or DEFAULT_COMMIT_EVERY.get(commit_policy)
+        self.failed_count = 0
+        self.uncommitted_limit = uncommitted_limit
+        self.uncommitted_overflow = uncommitted_overflow
+        self.chunk_size = chunk_size
+        self.resume_keys = resume_keys or dict()
+        self.last_keys = dict()
+        self.natural_key_cache_size = natural_key_cache_size or DEFAULT_NATURAL_KEY_CACHE_SIZE
+        self.raw_export = raw_export
+        self.workers = workers or 1
+        self.fast_load = fast_load
+        self.upsert_key = upsert_key
+        self.skip_unchanged = skip_unchanged
+        self.skipped_count = 0
+        self._bulk_models = dict()
+        
+        self._count_lock = threading.Lock()
         
         #this is so we can view objects and then easily commit
         if track_uncommitted:
-            self.deserialized_objects = deque()
+            self.deserialized_objects = self.get_uncommitted_queue()
         else:
             self.deserialized_objects = None
         super(ModelDataTap, self).__init__(instream, **kwargs)
@@ -55,34 +894,206 @@ class ModelDataTap(DataTap):
                 is_instance = isinstance(source, models.Model)
             
             if is_model:
-                queryset = source.objects.all().iterator()
-            elif is_instance:
+                source = source.objects.all()
+            if hasattr(source, 'iterator') and self.use_natural_keys:
+                source = self.select_natural_key_relations(source)
+            if is_instance:
                 queryset = [source]
+            elif self.chunk_size and hasattr(source, 'iterator') and source.query.can_filter():
+                queryset = self.get_keyset_stream(source)
+            elif hasattr(source, 'iterator'):
+                queryset = self.get_iterator_stream(source)
             else:
-                if hasattr(source, 'iterator'):
-                    queryset = source.iterator()
-                else:
-                    queryset = source
+                queryset = source
             for item in queryset:
                 yield item
     
+    def get_iterator_stream(self, queryset):
+        '''
+        Iterates a queryset without caching its rows. iterator() skips
+        prefetch_related, so the lookups are prefetched for every
+        `PREFETCH_BATCH_SIZE` instances instead.
+        '''
+        lookups = getattr(queryset, '_prefetch_related_lookups', None)
+        if not lookups or prefetch_related_objects is None:
+            return queryset.iterator()
+        return self.prefetch_batches(queryset.iterator(), lookups)
+    
+    def prefetch_batches(self, instances, lookups):
+        while True:
+            batch = list(islice(instances, PREFETCH_BATCH_SIZE))
+            if not batch:
+                break
+            prefetch_related_objects(batch, list(lookups))
+            for item in batch:
+                yield item
+    
+    def select_natural_key_relations(self, queryset):
+        '''
+        Joins or prefetches the related objects the serializer will ask for
+        natural keys
+        '''
+        opts = queryset.model._meta
+        foreign_keys = [field.name for field in opts.local_fields
+                        if field.rel and field.serialize and hasattr(field.rel.to, 'natural_key')]
+        many_to_many = [field.name for field in opts.many_to_many
+                        if field.serialize and field.rel.through._meta.auto_created and hasattr(field.rel.to, 'natural_key')]
+        if foreign_keys:
+            queryset = queryset.select_related(*foreign_keys)
+        if many_to_many and hasattr(queryset, 'prefetch_related'):
+            queryset = queryset.prefetch_related(*many_to_many)
+        return queryset
+    
+    def get_keyset_stream(self, queryset, get_key=attrgetter('pk')):
+        '''
+        Walks a queryset in primary key order fetching `chunk_size` rows per
+        query, so no query is held open for the whole export
+        '''
+        label = smart_unicode(queryset.model._meta)
+        queryset = queryset.order_by('pk')
+        last_key = self.resume_keys.get(label)
+        while True:
+            chunk = queryset
+            if last_key is not None:
+                chunk = chunk.filter(pk__gt=last_key)
+            chunk = list(chunk[:self.chunk_size])
+            for item in chunk:
+                yield item
+                self.last_keys[label] = last_key = get_key(item)
+            if len(chunk) < self.chunk_size:
+                break
+    
     def get_primitive_stream(self, instream):
         '''
         Convert various model sources to primitive objects
         '''
-        serializer = FileAwareSerializer()
+        if self.workers > 1:
+            return iter(ParallelExport(self, sort_sources(instream), self.workers))
+        return self.get_serial_primitive_stream(instream)
+    
+    def get_serial_primitive_stream(self, instream):
+        serializer = FileAwareSerializer(natural_key_cache=LRUCache(self.natural_key_cache_size))
+        if self.raw_export:
+            return self.get_raw_primitive_stream(serializer, instream)
         instances = self.get_instance_stream(instream)
         return serializer.serialize(instances, use_natural_keys=self.use_natural_keys)
     
+    def get_raw_primitive_stream(self, serializer, instream):
+        '''
+        Convert model sources to primitive objects from values_list() rows,
+        falling back to instances per source
+        '''
+        for source in instream:
+            try:
+                is_model = issubclass(source, models.Model)
+            except TypeError:
+                is_model = False
+            if is_model:
+                source = source.objects.all()
+            columns = None
+            if hasattr(source, 'iterator'):
+                serializer.start_options({'use_natural_keys': self.use_natural_keys})
+                plan = serializer.get_plan(source.model)
+                columns = plan.columns
+            if columns is None:
+                for item in serializer.serialize(self.get_instance_stream([source]), use_natural_keys=self.use_natural_keys):
+                    yield item
+                continue
+            rows = source.values_list(*columns)
+            if self.chunk_size and source.query.can_filter():
+                rows = self.get_keyset_stream(rows, get_key=itemgetter(0))
+            else:
+                rows = rows.iterator()
+            for row in rows:
+                yield plan.serialize_row(row)
+    
     def get_deserialized_model_stream(self, instream):
         '''
         Convert primitive objects to deserialized model instances
         '''
-        for deserialized_model in Deserializer(instream):
+        for deserialized_model in self.deserialize(instream):
             if self.deserialized_objects is not None:
+                if (self.uncommitted_limit and self.uncommitted_overflow == 'flush' and
+                    len(self.deserialized_objects) >= self.uncommitted_limit):
+                    self.flush_uncommitted()
                 self.deserialized_objects.append(deserialized_model)
             yield deserialized_model
     
+    def deserialize(self, object_list):
+        '''
+        Deserializes primitives like django's python Deserializer, resolving
+        natural keys with a `NaturalKeyResolver`. Primitives are read in batches
+        so the natural keys referenced by a batch are looked up together.
+        '''
+        resolver = NaturalKeyResolver(self.natural_key_cache_size)
+        models.get_apps()
+        object_list = iter(object_list)
+        while True:
+            batch = list(islice(object_list, NATURAL_KEY_BATCH_SIZE))
+            if not batch:
+                break
+            natural_keys = dict()
+            for d in batch:
+                Model = _get_model(d['model'])
+                for field_name, field_value in d['fields'].iteritems():
+                    field = Model._meta.get_field(field_name)
+                    if not field.rel or not hasattr(field.rel.to._default_manager, 'get_by_natural_key'):
+                        continue
+                    if isinstance(field.rel, models.ManyToManyRel):
+                        values = field_value
+                    else:
+                        values = [field_value]
+                    for value in values:
+                        if hasattr(value, '__iter__'):
+                            natural_keys.setdefault(field.rel.to, list()).append(tuple(value))
+            for model, keys in natural_keys.iteritems():
+                resolver.prefetch(model, keys)
+            for d in batch:
+                deserialized = self.deserialize_object(d, resolver)
+                resolver.register(deserialized.object)
+                yield deserialized
+    
+    def deserialize_object(self, d, resolver):
+        Model = _get_model(d['model'])
+        data = {Model._meta.pk.attname: Model._meta.pk.to_python(d['pk'])}
+        m2m_data = {}
+        
+        for (field_name, field_value) in d['fields'].iteritems():
+            if isinstance(field_value, str):
+                field_value = smart_unicode(field_value, settings.DEFAULT_CHARSET, strings_only=True)
+            
+            field = Model._meta.get_field(field_name)
+            natural_keys = field.rel is not None and hasattr(field.rel.to._default_manager, 'get_by_natural_key')
+            
+            # Handle M2M relations
+            if field.rel and isinstance(field.rel, models.ManyToManyRel):
+                def m2m_convert(value):
+                    if natural_keys and hasattr(value, '__iter__'):
+                        return resolver.resolve(field.rel.to, value).pk
+                    return smart_unicode(field.rel.to._meta.pk.to_python(value))
+                m2m_data[field.name] = [m2m_convert(pk) for pk in field_value]
+            
+            # Handle FK fields
+            elif field.rel and isinstance(field.rel, models.ManyToOneRel):
+                if field_value is None:
+                    data[field.attname] = None
+                elif natural_keys and hasattr(field_value, '__iter__'):
+                    obj = resolver.resolve(field.rel.to, field_value)
+                    value = getattr(obj, field.rel.field_name)
+                    # If this is a natural foreign key to an object that
+                    # has a FK/O2O as the foreign key, use the FK value
+                    if field.rel.to._meta.pk.rel:
+                        value = value.pk
+                    data[field.attname] = value
+                else:
+                    data[field.attname] = field.rel.to._meta.get_field(field.rel.field_name).to_python(field_value)
+            
+            # Handle all other fields
+            else:
+                data[field.name] = field.to_python(field_value)
+        
+        return base.DeserializedObject(Model(**data), m2m_data)
+    
     def get_model_stream(self, instream):
         '''
         Convert primitive objects to saved model instances
@@ -91,23 +1102,281 @@ class ModelDataTap(DataTap):
             item.save()
             yield item.object
     
-    @transaction.commit_manually
-    def commit(self):
-        if transaction.is_dirty():
-            transaction.commit()
+    def get_uncommitted_queue(self):
+        if self.uncommitted_limit and self.uncommitted_overflow == 'spool':
+            return UncommittedJournal(self.uncommitted_limit)
+        return deque()
+    
+    def get_tracked_stream(self):
+        '''
+        Yields and forgets the tracked deserialized objects
+        '''
         while self.deserialized_objects:
-            instance = self.deserialized_objects.popleft()
-            instance.save()
-            transaction.commit()
+            yield self.deserialized_objects.popleft()
+    
+    def get_uncommitted_stream(self):
+        '''
+        Yields the tracked deserialized objects followed by the rest of the stream
+        '''
+        for instance in self.get_tracked_stream():
+            yield instance
         self.deserialized_objects = None
         for instance in self:
-            instance.save()
+            yield instance
+    
+    def is_bulk_model(self, model):
+        '''
+        Returns True if instances of the model can be inserted with bulk_create
+        without losing what a raw save would store
+        '''
+        if model not in self._bulk_models:
+            bulk = hasattr(model._base_manager, 'bulk_create') and not model._meta.parents
+            for field in model._meta.local_fields:
+                #these fields alter values in pre_save which bulk_create calls
+                if isinstance(field, models.FileField) or getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False):
+                    bulk = False
+            self._bulk_models[model] = bulk
+        return self._bulk_models[model]
+    
+    def can_bulk_create(self, deserialized):
+        if self.commit_mode not in ('bulk', 'upsert'):
+            return False
+        if deserialized.m2m_data and any(deserialized.m2m_data.values()):
+            return False
+        return self.is_bulk_model(type(deserialized.object))
+    
+    def get_commit_batches(self, deserialized_objects):
+        '''
+        Groups consecutive objects of the same model into bulk batches of up
+        to `batch_size`, yielding (is_bulk, objects). Objects that cannot be
+        bulk created are yielded on their own.
+        '''
+        batch = list()
+        for deserialized in deserialized_objects:
+            if not self.can_bulk_create(deserialized):
+                if batch:
+                    yield True, batch
+                    batch = list()
+                yield False, [deserialized]
+                continue
+            if batch and (type(batch[0].object) is not type(deserialized.object) or len(batch) >= self.batch_size):
+                yield True, batch
+                batch = list()
+            batch.append(deserialized)
+        if batch:
+            yield True, batch
+    
+    def save_batch(self, is_bulk, batch):
+        if is_bulk and self.commit_mode == 'upsert':
+            self.upsert_batch(batch)
+        elif is_bulk:
+            model = type(batch[0].object)
+            model._base_manager.bulk_create([deserialized.object for deserialized in batch])
+        else:
+            for deserialized in batch:
+                self.save_object(deserialized)
+    
+    def upsert_batch(self, batch):
+        model = type(batch[0].object)
+        connection = connections[router.db_for_write(model)]
+        query = None
+        if UpsertQuery.is_supported(connection):
+            query = UpsertQuery(model, connection, self.upsert_key)
+        if query is None or query.has_other_unique_keys():
+            for deserialized in batch:
+                self.save_object(deserialized)
+            return
+        objs = [deserialized.object for deserialized in batch]
+        if self.skip_unchanged:
+            changed = query.get_changed(objs)
+            with self._count_lock:
+                self.skipped_count += len(objs) - len(changed)
+            objs = changed
+        if objs:
+            query.execute(objs)
+    
+    def save_object(self, deserialized):
+        if self.commit_mode == 'upsert' and self.upsert_key == 'natural':
+            self.resolve_natural_upsert_key(deserialized.object)
+        if not self.fast_load:
+            deserialized.save()
+            return
+        instance = deserialized.object
+        #without an origin save_base sends no signals
+        models.Model.save_base(instance, raw=True, cls=type(instance))
+        for field_name, values in (deserialized.m2m_data or {}).items():
+            self.save_m2m_rows(instance, instance._meta.get_field(field_name), values)
+    
+    def resolve_natural_upsert_key(self, instance):
+        '''
+        Points an object saved outside the native upsert at the row with its
+        natural key, leaving the automatic primary key of a new row to the
+        database as `UpsertQuery` does
+        '''
+        model = type(instance)
+        key_fields = get_natural_key_fields(model)
+        if not key_fields:
+            return
+        lookup = dict((field.name, getattr(instance, field.attname)) for field in key_fields)
+        pks = list(model._base_manager.using(router.db_for_write(model)).filter(**lookup).values_list('pk', flat=True)[:1])
+        if pks:
+            instance.pk = pks[0]
+        elif isinstance(model._meta.pk, models.AutoField):
+            instance.pk = None
+    
+    def save_m2m_rows(self, instance, field, values):
+        '''
+        Replaces the many to many rows of the instance without the m2m_changed signals
+        '''
+        through = field.rel.through
+        source = through._meta.get_field(field.m2m_field_name())
+        target = through._meta.get_field(field.m2m_reverse_field_name())
+        using = instance._state.db or DEFAULT_DB_ALIAS
+        DeleteQuery(through).delete_batch([instance._get_pk_val()], using, field=source)
+        rows = [through(**{source.attname: instance._get_pk_val(), target.attname: value}) for value in values]
+        manager = through._base_manager.using(using)
+        if hasattr(manager, 'bulk_create'):
+            manager.bulk_create(rows)
+        else:
+            for row in rows:
+                models.Model.save_base(row, raw=True, cls=through, using=using)
+    
+    def save_batch_in_savepoint(self, is_bulk, batch):
+        '''
+        Saves a batch within a savepoint. A failing bulk batch is retried one
+        object at a time so that only the failing rows are skipped.
+        '''
+        sid = transaction.savepoint()
+        try:
+            self.save_batch(is_bulk, batch)
+        except Exception, error:
+            transaction.savepoint_rollback(sid)
+            if len(batch) > 1:
+                for deserialized in batch:
+                    self.save_batch_in_savepoint(is_bulk, [deserialized])
+            else:
+                with self._count_lock:
+                    self.failed_count += 1
+                self.get_logger().error('Skipping %r, failed to save: %s', batch[0], error)
+        else:
+            transaction.savepoint_commit(sid)
+    
+    def should_commit(self, pending, last_commit):
+        if self.commit_policy == 'object':
+            return True
+        if self.commit_policy == 'count':
+            return pending >= self.commit_every
+        if self.commit_policy == 'time':
+            return time.time() - last_commit >= self.commit_every
+        return False
+    
+    def commit(self):
+        '''
+        Saves the tracked objects and the rest of the stream
+        '''
+        self.save_stream(self.get_uncommitted_stream())
+    
+    def flush_uncommitted(self):
+        '''
+        Saves the tracked objects, the rest of the stream is left untouched
+        '''
+        self.save_stream(self.get_tracked_stream())
+    
+    def save_stream(self, deserialized_objects):
+        if self.workers > 1:
+            ParallelImport(self, deserialized_objects, self.workers).run()
+        else:
+            self.commit_stream(deserialized_objects)
+    
+    @transaction.commit_manually
+    def commit_stream(self, deserialized_objects):
+        if transaction.is_dirty():
             transaction.commit()
+        try:
+            if self.fast_load:
+                self.fast_load_batches(deserialized_objects)
+            else:
+                self.save_batches(deserialized_objects)
+        except:
+            transaction.rollback()
+            raise
         if transaction.is_dirty():
             transaction.commit()
     
+    def fast_load_batches(self, deserialized_objects):
+        '''
+        Saves the objects with the constraint checks disabled, verifying the
+        saved tables before the caller commits the one transaction
+        '''
+        connection = connections[DEFAULT_DB_ALIAS]
+        if hasattr(connection, 'constraint_checks_disabled'):
+            with connection.constraint_checks_disabled():
+                saved_models = self.save_batches(deserialized_objects)
+                table_names = set()
+                for model in saved_models:
+                    table_names.add(model._meta.db_table)
+                    for field in model._meta.many_to_many:
+                        if field.rel.through._meta.auto_created:
+                            table_names.add(field.rel.through._meta.db_table)
+                connection.check_constraints(table_names=sorted(table_names))
+        else:
+            #django 1.3 checks the constraints as rows are saved
+            saved_models = self.save_batches(deserialized_objects)
+        sequence_sql = connection.ops.sequence_reset_sql(no_style(), list(saved_models))
+        if sequence_sql:
+            cursor = connection.cursor()
+            for line in sequence_sql:
+                cursor.execute(line)
+            transaction.set_dirty()
+    
+    def save_batches(self, deserialized_objects):
+        '''
+        Saves the objects committing as the policy asks, returns the saved models
+        '''
+        use_savepoints = self.commit_policy in ('count', 'time')
+        pending = 0
+        last_commit = time.time()
+        saved_models = set()
+        for is_bulk, batch in self.get_commit_batches(deserialized_objects):
+            if use_savepoints:
+                self.save_batch_in_savepoint(is_bulk, batch)
+            else:
+                self.save_batch(is_bulk, batch)
+            saved_models.add(type(batch[0].object))
+            pending += len(batch)
+            if self.should_commit(pending, last_commit):
+                transaction.commit()
+                pending = 0
+                last_commit = time.time()
+        return saved_models
+    
     command_option_list = [
         Option('--disable_natural_keys', action='store_false', dest='use_natural_keys'),
+        Option('--bulk', action='store_const', const='bulk', dest='commit_mode', default='save',
+               help='Insert consecutive objects of a model with bulk_create'),
+        Option('--upsert', action='store_const', const='upsert', dest='commit_mode',
+               help='Insert or update consecutive objects of a model with the native upsert of the backend'),
+        Option('--upsert-key', action='store', type='choice', choices=UPSERT_KEYS, dest='upsert_key', default='pk',
+               help='Match existing rows on the primary key or the natural key, one of: %s' % ', '.join(UPSERT_KEYS)),
+        Option('--skip-unchanged', action='store_true', dest='skip_unchanged', default=False,
+               help='Skip upserting rows whose content matches the stored row'),
+        Option('--batch-size', action='store', type='int', dest='batch_size'),
+        Option('--commit-policy', action='store', type='choice', choices=COMMIT_POLICIES, dest='commit_policy',
+               help='When to commit: after every object (default), all at once (default and only choice with '
+                    '--fast-load), every N objects (count) or every N seconds (time)'),
+        Option('--commit-every', action='store', type='float', dest='commit_every',
+               help='Number of objects or seconds between commits'),
+        Option('--chunk-size', action='store', type='int', dest='chunk_size',
+               help='Export in primary key order fetching this many rows per query'),
+        Option('--raw-export', action='store_true', dest='raw_export', default=False,
+               help='Export models without custom natural keys, file or many to many fields from values_list() rows'),
+        Option('--workers', action='store', type='int', dest='workers',
+               help='Export or save models on this many threads, each with its own database connection and '
+                    'transactions, so not with --commit-policy=all'),
+        Option('--fast-load', action='store_true', dest='fast_load', default=False,
+               help='Save without signals, checking foreign keys once at the end and resetting sequences'),
+        Option('--resume', action='append', dest='resume_keys', metavar='APP.MODEL=PK',
+               help='Resume a chunked export of a model after the given primary key'),
     ]
     
     @classmethod
@@ -115,6 +1384,7 @@ class ModelDataTap(DataTap):
         parser = OptionParser(option_list=cls.command_option_list)
         options, args = parser.parse_args(arglist)
         kwargs = options.__dict__
+        kwargs['resume_keys'] = dict(entry.split('=', 1) for entry in kwargs['resume_keys'] or [])
         if instream is None:
             model_sources = list()
             for arg in args: #list of apps and model names
@@ -1,31 +1,192 @@
 import io
 import os
+import Queue
+import threading
 from optparse import Option, OptionParser
 
-from boto.s3.connection import S3Connection
+from boto.s3.connection import S3Connection, OrdinaryCallingFormat
 
 from django.conf import settings
 
 from datatap.loading import register_datatap
+from datatap.utils import LRUCache
 from datatap.datataps.streams import StreamDataTap
 
 
-class S3Upload(io.BytesIO):
-    def __init__(self, bucket_key):
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+#S3 rejects any part but the last that is smaller
+MIN_PART_SIZE = 5 * 1024 * 1024
+DEFAULT_CONCURRENCY = 4
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+DEFAULT_CACHED_BLOCKS = 4
+READ_MODES = ('download', 'stream', 'ranged')
+
+class S3Upload(object):
+    '''
+    A write only file object that streams to an S3 key with a multipart
+    upload. Parts of `part_size` bytes are sent by `concurrency` worker
+    threads and at most `concurrency` parts wait in the buffer, so writes
+    block rather than grow memory. S3 requires parts of at least 5MB.
+    '''
+    def __init__(self, bucket_key, part_size=None, concurrency=None):
         self.bucket_key = bucket_key
+        self.part_size = part_size or DEFAULT_PART_SIZE
+        assert self.part_size >= MIN_PART_SIZE, 'S3 parts must be at least %s bytes' % MIN_PART_SIZE
+        self.concurrency = concurrency or DEFAULT_CONCURRENCY
+        self.buffer = io.BytesIO()
+        self.position = 0
+        self.part_num = 0
+        self.multipart = None
+        self.parts = Queue.Queue(maxsize=self.concurrency)
+        self.workers = list()
+        self.errors = list()
         self._closed = False
-        super(S3Upload, self).__init__()
     
     def __del__(self):
-        self.close()
+        #an upload rejected by __init__ never started
+        if not getattr(self, '_closed', True):
+            self.cancel()
+    
+    def start_upload(self):
+        self.multipart = self.bucket_key.bucket.initiate_multipart_upload(self.bucket_key.name)
+        for i in range(self.concurrency):
+            worker = threading.Thread(target=self.upload_parts)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+    
+    def upload_parts(self):
+        while True:
+            part = self.parts.get()
+            try:
+                if part is None:
+                    return
+                part_num, payload = part
+                if not self.errors:
+                    self.multipart.upload_part_from_file(io.BytesIO(payload), part_num)
+            except Exception, error:
+                self.errors.append(error)
+            finally:
+                self.parts.task_done()
+    
+    def stop_workers(self):
+        for worker in self.workers:
+            self.parts.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = list()
+    
+    def send_part(self, payload):
+        if self.errors:
+            raise self.errors[0]
+        if self.multipart is None:
+            self.start_upload()
+        self.part_num += 1
+        self.parts.put((self.part_num, payload))
+    
+    def tell(self):
+        return self.position
+    
+    def flush(self):
+        pass
+    
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self.buffer.write(data)
+        self.position += len(data)
+        while self.buffer.tell() >= self.part_size:
+            payload = self.buffer.getvalue()
+            self.buffer = io.BytesIO()
+            self.buffer.write(payload[self.part_size:])
+            self.send_part(payload[:self.part_size])
+    
+    def cancel(self):
+        '''
+        Aborts the upload, discarding any parts already sent
+        '''
+        self._closed = True
+        if self.multipart is not None:
+            self.stop_workers()
+            self.multipart.cancel_upload()
+            self.multipart = None
     
     def close(self):
-        if not self._closed:
-            #TODO dont convert to a string first
-            self.seek(0)
-            self.bucket_key.set_contents_from_string(self.read())
+        if self._closed:
+            return
+        if self.multipart is None:
+            #everything fit in one part, a single request will do
+            self._closed = True
+            self.bucket_key.set_contents_from_string(self.buffer.getvalue())
+            return
+        try:
+            if self.buffer.tell():
+                self.send_part(self.buffer.getvalue())
+            self.stop_workers()
+            if self.errors:
+                raise self.errors[0]
+        except:
+            self.cancel()
+            raise
         self._closed = True
-        
+        self.multipart.complete_upload()
+
+class S3RangedFile(object):
+    '''
+    A read only, seekable file object over an S3 key that fetches byte
+    ranges as they are read, in blocks of `block_size` bytes. The last
+    `cached_blocks` blocks fetched are kept, so readers interleaving several
+    regions, like zipfile reading two members, don't refetch on every read.
+    Reads larger than a block are fetched with a request of their own.
+    '''
+    def __init__(self, bucket_key, block_size=None, cached_blocks=None):
+        self.bucket_key = bucket_key
+        self.size = bucket_key.size
+        self.block_size = block_size or DEFAULT_BLOCK_SIZE
+        self.blocks = LRUCache(cached_blocks or DEFAULT_CACHED_BLOCKS)
+        self.position = 0
+    
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.position = max(offset, 0)
+    
+    def tell(self):
+        return self.position
+    
+    def fetch(self, start, length):
+        end = min(start + length, self.size) - 1
+        headers = {'Range': 'bytes=%s-%s' % (start, end)}
+        return self.bucket_key.get_contents_as_string(headers=headers)
+    
+    def get_block(self, index):
+        block = self.blocks.get(index)
+        if block is None:
+            block = self.fetch(index * self.block_size, self.block_size)
+            self.blocks[index] = block
+        return block
+    
+    def read(self, size=-1):
+        remaining = self.size - self.position
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        if size <= 0:
+            return ''
+        if size > self.block_size:
+            data = self.fetch(self.position, size)
+        else:
+            #a read no larger than a block spans at most two
+            first = self.position // self.block_size
+            last = (self.position + size - 1) // self.block_size
+            start = self.position - first * self.block_size
+            data = ''.join(self.get_block(index) for index in range(first, last + 1))[start:start + size]
+        self.position += len(data)
+        return data
+    
+    def close(self):
+        self.blocks = LRUCache(self.blocks.size)
 
 class S3DataTap(StreamDataTap):
     '''
@@ -36,37 +197,83 @@ class S3DataTap(StreamDataTap):
     
     S3BucketDT(ZipDT(ModelDT)).send(key_name) => write a zip archive to key name
     ModelDT(ZipDt(S3BucketDT(key_name))) => load models from zip archive at key name
+    
+    Keys are read according to `read_mode`: "download" fetches the whole key
+    into memory first, "stream" feeds bytes as they arrive and "ranged" gives
+    a seekable file that fetches byte ranges on demand (best for zip archives).
     '''
-    def __init__(self, instream=None, key_name=None, aws_access_key_id=None, aws_secret_access_key=None, bucket_name=None, **kwargs):
+    def __init__(self, instream=None, key_name=None, aws_access_key_id=None, aws_secret_access_key=None, bucket_name=None,
+                 host=None, port=None, is_secure=True, part_size=None, concurrency=None,
+                 read_mode=None, block_size=None, cached_blocks=None, **kwargs):
+        '''
+        :param host: An alternative S3 compatible host to connect to
+        :param read_mode: One of "download" (default), "stream" or "ranged"
+        :param block_size: The number of bytes fetched per ranged request
+        :param cached_blocks: The number of ranged blocks kept in memory
+        :param part_size: The number of bytes per part for multipart uploads
+        :param concurrency: The number of parts to upload at once
+        '''
+        assert part_size is None or part_size >= MIN_PART_SIZE, 'S3 parts must be at least %s bytes' % MIN_PART_SIZE
+        self.part_size = part_size
+        self.concurrency = concurrency
         if aws_access_key_id is None:
             aws_access_key_id = getattr(settings, 'AWS_ACCESS_KEY_ID', None) or os.environ['AWS_ACCESS_KEY_ID']
         if aws_secret_access_key is None:
             aws_secret_access_key = getattr(settings, 'AWS_SECRET_ACCESS_KEY', None) or os.environ['AWS_SECRET_ACCESS_KEY']
         if bucket_name is None:
             bucket_name = getattr(settings, 'AWS_STORAGE_BUCKET_NAME', None) or os.environ['AWS_STORAGE_BUCKET_NAME']
-        self.connection = S3Connection(aws_access_key_id, aws_secret_access_key)
+        connection_kwargs = {'is_secure': is_secure, 'port': port}
+        host = host or getattr(settings, 'AWS_S3_HOST', None)
+        if host:
+            #S3 compatible services rarely support bucket subdomains
+            connection_kwargs['host'] = host
+            connection_kwargs['calling_format'] = OrdinaryCallingFormat()
+        self.connection = S3Connection(aws_access_key_id, aws_secret_access_key, **connection_kwargs)
         self.bucket = self.connection.get_bucket(bucket_name)
         if key_name: 
             #CONSIDER: without a key name or instream we are a primitive serializer acting much like a tarfile and assets in a dir
             #would require paramater: key_directory
             assert instream is None, 'You cannot read from two sources, use .send(key_name) if you wish to write'
+            read_mode = read_mode or 'download'
+            assert read_mode in READ_MODES, 'Unrecognized read mode: %s' % read_mode
             key = self.bucket.get_key(key_name)
-            instream = io.BytesIO()
-            key.get_contents_to_file(instream)
-            instream.seek(0)
-            instream = instream
+            if read_mode == 'stream':
+                #boto keys read straight from the response as it arrives
+                instream = key
+            elif read_mode == 'ranged':
+                instream = S3RangedFile(key, block_size, cached_blocks)
+            else:
+                instream = io.BytesIO()
+                key.get_contents_to_file(instream)
+                instream.seek(0)
         super(S3DataTap, self).__init__(instream, **kwargs)
     
     def send(self, key_name):
         key = self.bucket.new_key(key_name)
-        fileobj = S3Upload(key)
-        return super(S3DataTap, self).send(fileobj)
+        fileobj = S3Upload(key, part_size=self.part_size, concurrency=self.concurrency)
+        try:
+            result = super(S3DataTap, self).send(fileobj)
+        except:
+            fileobj.cancel()
+            raise
+        fileobj.close()
+        return result
     
     command_option_list = [
         Option('--key-name', action='store', dest='key_name'),
         Option('--bucket', action='store', dest='bucket_name'),
         Option('--access-key-id', action='store', dest='aws_access_key_id'),
         Option('--secret-access-key', action='store', dest='aws_secret_access_key'),
+        Option('--host', action='store', dest='host'),
+        Option('--port', action='store', type='int', dest='port'),
+        Option('--insecure', action='store_false', dest='is_secure', default=True),
+        Option('--part-size', action='store', type='int', dest='part_size',
+               help='The number of bytes per part for multipart uploads, at least %s' % MIN_PART_SIZE),
+        Option('--concurrency', action='store', type='int', dest='concurrency'),
+        Option('--read-mode', action='store', type='choice', choices=READ_MODES, dest='read_mode'),
+        Option('--block-size', action='store', type='int', dest='block_size'),
+        Option('--cached-blocks', action='store', type='int', dest='cached_blocks',
+               help='The number of blocks kept in memory when reading ranges'),
     ]
     
     @classmethod
@@ -1,9 +1,10 @@
 import sys
 import urllib2 #TODO requests
 from io import BytesIO
-from optparse import OptionParser
+from optparse import OptionParser, Option
 
-from datatap.encoders import DataTapJSONEncoder, DataTapJSONDecoder
+from datatap.encoders import (DataTapJSONEncoder, DataTapJSONDecoder, DataTapBinaryEncoder, DataTapBinaryDecoder,
+                              DataTapColumnarEncoder, DataTapColumnarDecoder)
 from datatap.loading import register_datatap
 from datatap.datataps.base import DataTap
 
@@ -98,6 +99,16 @@ class JSONDataTap(DataTap):
     JSONDT(ModelDT) => json representation of models
     JSONDT(FileDT(filename)) => decoded json from filename
     '''
+    #archives name their manifest after it
+    extension = 'json'
+    
+    def __init__(self, instream=None, chunk_size=None, **kwargs):
+        '''
+        :param chunk_size: The number of bytes to read at a time when decoding
+        '''
+        self.chunk_size = chunk_size
+        super(JSONDataTap, self).__init__(instream, **kwargs)
+    
     def get_domain(self):
         if self.instream.domain == 'primitive':
             return 'bytes'
@@ -110,6 +121,98 @@ class JSONDataTap(DataTap):
     
     def get_primitive_stream(self, instream):
         decoder = DataTapJSONDecoder(filetap=self.filetap)
-        return decoder.decode(instream.read())
+        return decoder.iterdecode(instream, self.chunk_size)
 
 register_datatap('JSON', JSONDataTap)
+
+class NDJSONDataTap(JSONDataTap):
+    '''
+    A data tap that converts primitive objects to and from newline delimited
+    JSON, one primitive per line, so the lines may be split and processed
+    independently
+    
+    NDJSONDT(ModelDT) => a line of json per model
+    NDJSONDT(FileDT(filename)) => decoded lines from filename
+    '''
+    extension = 'ndjson'
+    
+    def get_bytes_stream(self, instream):
+        encoder = DataTapJSONEncoder(filetap=self.filetap)
+        return encoder.iterencode_lines(iter(instream))
+    
+    def get_primitive_stream(self, instream):
+        decoder = DataTapJSONDecoder(filetap=self.filetap)
+        return decoder.iterdecode_lines(instream, self.chunk_size)
+
+register_datatap('NDJSON', NDJSONDataTap)
+
+class BinaryDataTap(JSONDataTap):
+    '''
+    A data tap that converts primitive objects to and from length prefixed
+    binary records. Model records are written against a table of their
+    field names, dates, times and decimals are stored natively.
+    
+    BinaryDT(ModelDT) => binary representation of models
+    BinaryDT(FileDT(filename)) => decoded records from filename
+    '''
+    extension = 'bin'
+    
+    def get_bytes_stream(self, instream):
+        encoder = DataTapBinaryEncoder(filetap=self.filetap)
+        return encoder.iterencode(iter(instream))
+    
+    def get_primitive_stream(self, instream):
+        decoder = DataTapBinaryDecoder(filetap=self.filetap)
+        return decoder.iterdecode(instream, self.chunk_size)
+
+register_datatap('Binary', BinaryDataTap)
+
+class ColumnarDataTap(JSONDataTap):
+    '''
+    A data tap that converts primitive objects to and from row groups of
+    typed, compressed columns with min and max statistics. Consecutive model
+    records with the same fields share a row group of up to `row_group_size`
+    rows.
+    
+    ColumnarDT(ModelDT) => columnar representation of models
+    ColumnarDT(FileDT(filename)) => decoded records from filename
+    '''
+    extension = 'col'
+    
+    def __init__(self, instream=None, row_group_size=None, compression_level=None, **kwargs):
+        '''
+        :param row_group_size: The maximum number of rows per row group
+        :param compression_level: The zlib compression level of the columns
+        '''
+        self.row_group_size = row_group_size
+        self.compression_level = compression_level
+        super(ColumnarDataTap, self).__init__(instream, **kwargs)
+    
+    def get_bytes_stream(self, instream):
+        encoder = DataTapColumnarEncoder(filetap=self.filetap, row_group_size=self.row_group_size,
+                                         compression_level=self.compression_level)
+        return encoder.iterencode(iter(instream))
+    
+    def get_primitive_stream(self, instream):
+        decoder = DataTapColumnarDecoder(filetap=self.filetap)
+        return decoder.iterdecode(instream, self.chunk_size)
+    
+    def get_column_batches(self):
+        '''
+        Yields the row groups of the instream as `ColumnBatch` objects, whose
+        columns can be loaded without building a primitive per row
+        '''
+        decoder = DataTapColumnarDecoder(filetap=self.filetap)
+        return decoder.iterbatches(self.instream, self.chunk_size)
+    
+    command_option_list = [
+        Option('--row-group-size', action='store', type='int', dest='row_group_size',
+               help='The maximum number of rows per row group'),
+        Option('--compression-level', action='store', type='int', dest='compression_level',
+               help='The zlib compression level of the columns, 0 to 9'),
+    ]
+
+register_datatap('Columnar', ColumnarDataTap)
+
+#datataps an archive may encode its manifest with
+MANIFEST_DATATAPS = (JSONDataTap, NDJSONDataTap, BinaryDataTap, ColumnarDataTap)
@@ -1,15 +1,19 @@
 from __future__ import absolute_import
 
+import re
 import tarfile
+import tempfile
 from optparse import Option
 from io import BytesIO
 from copy import copy
+from itertools import islice
 
 from django.core.files.base import File
 
-from datatap.loading import register_datatap
+from datatap.loading import register_datatap, lookup_datatap
 from datatap.datataps.base import DataTap, FileTap
-from datatap.datataps.streams import StreamDataTap, JSONDataTap
+from datatap.datataps.memory import MemoryDataTap
+from datatap.datataps.streams import StreamDataTap, MANIFEST_DATATAPS
 
 
 class DjangoTarExtFile(File):
@@ -20,6 +24,32 @@ class DjangoTarExtFile(File):
         self.name = tarinfo.name
         self._size = tarinfo.size
 
+class DjangoTarStreamFile(File):
+    '''
+    A django file for an asset of a streamed archive that is only reached
+    when it is first read
+    '''
+    def __init__(self, filetap, path):
+        self.filetap = filetap
+        self.path = path
+        self.mode = 'r'
+        self.name = path
+        self._file = None
+    
+    def _get_file(self):
+        if self._file is None:
+            tar_file = self.filetap.fetch(self.path)
+            self._file = tar_file.file
+            self._size = tar_file.tarinfo.size
+            self._file.seek(0)
+        return self._file
+    file = property(_get_file)
+    
+    def _get_size(self):
+        self.file
+        return self._size
+    size = property(_get_size)
+
 class WritableTarExtFile(BytesIO):
     def __init__(self, archive, path, payload):
         self.archive = archive
@@ -36,31 +66,136 @@ class WritableTarExtFile(BytesIO):
     
 
 class TarFileTap(FileTap):
+    #entries larger than this are spooled to disk until they can be added
+    spool_size = 1024 * 1024
+    
     def __init__(self, archive, files=None):
         self.archive = archive
         self.files = files
+        self.deferred = None
+    
+    def spool(self, chunks):
+        spooled = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+        for chunk in chunks:
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode('utf-8')
+            spooled.write(chunk)
+        return spooled
+    
+    def add_spooled(self, path, spooled):
+        tarinfo = tarfile.TarInfo(path)
+        tarinfo.size = spooled.tell()
+        spooled.seek(0)
+        self.archive.addfile(tarinfo, spooled)
+        spooled.close()
+    
+    def write_stream(self, path, chunks, defer_files=False):
+        '''
+        Spools an iterable of chunks and adds it as an entry once its size is
+        known. With defer_files the files written meanwhile are added after
+        the entry rather than before it.
+        '''
+        if defer_files:
+            self.deferred = list()
+        try:
+            self.add_spooled(path, self.spool(chunks))
+            for spooled, spooled_path in self.deferred or []:
+                self.add_spooled(spooled_path, spooled)
+        finally:
+            self.deferred = None
     
     def write_file(self, file_obj, path):
-        #TODO write in chunks
         #TODO write in a directory
-        payload = file_obj.read()
+        if self.deferred is not None:
+            self.deferred.append((self.spool(file_obj.chunks()), path))
+            return path
+        #addfile copies the file in blocks of tarinfo.size bytes
         tarinfo = tarfile.TarInfo(path)
-        tarinfo.size = len(payload)
-        self.archive.addfile(tarinfo, BytesIO(payload))
+        tarinfo.size = file_obj.size
+        file_obj.seek(0)
+        self.archive.addfile(tarinfo, file_obj)
         return path
     
     def read_file(self, path, original_path):
-        loaded_file = copy(self.files[path])
+        if self.files is not None:
+            loaded_file = copy(self.files[path])
+        else:
+            tarinfo = self.archive.getmember(path)
+            loaded_file = DjangoTarExtFile(self.archive.extractfile(tarinfo), tarinfo)
+        loaded_file.name = original_path
+        loaded_file._committed = False
+        return loaded_file
+
+class StreamedTarFileTap(TarFileTap):
+    '''
+    Reads the assets of a streamed archive part. The archive is only read as
+    far as the asset being opened, the members passed over on the way are
+    spooled. Reaching the next manifest part ends this one.
+    '''
+    def __init__(self, archive, members, is_manifest):
+        super(StreamedTarFileTap, self).__init__(archive, dict())
+        self.members = members
+        self.is_manifest = is_manifest
+        self.next_manifest = None
+        self.finished = False
+    
+    def advance(self):
+        '''
+        Spools the next asset of this part, returns False once there are none
+        '''
+        if self.finished:
+            return False
+        tarinfo = next(self.members, None)
+        if tarinfo is None or self.is_manifest(tarinfo.name):
+            self.next_manifest = tarinfo
+            self.finished = True
+            return False
+        fileobj = self.archive.extractfile(tarinfo)
+        spooled = self.spool(iter(lambda: fileobj.read(File.DEFAULT_CHUNK_SIZE), ''))
+        self.files[tarinfo.name] = DjangoTarExtFile(spooled, tarinfo)
+        return True
+    
+    def fetch(self, path):
+        while path not in self.files:
+            if not self.advance():
+                raise KeyError('%s is not in this part of the archive' % path)
+        return self.files[path]
+    
+    def finish(self):
+        '''
+        Spools the unread assets of this part, returns the next manifest part
+        '''
+        while self.advance():
+            pass
+        return self.next_manifest
+    
+    def read_file(self, path, original_path):
+        loaded_file = DjangoTarStreamFile(self, path)
         loaded_file.name = original_path
         loaded_file._committed = False
         return loaded_file
 
+#the names of the parts written by a streamed archive
+MANIFEST_PART_RE = re.compile(r'^manifest-\d{6,}\.(\w+)$')
+
 class TarFileDataTap(DataTap):
     '''
-    Reads and writes objects from a zipfile
+    Reads and writes objects from a tarfile
+    
+    With `stream` the manifest is split into parts of `batch_size` records,
+    each written before the assets it references. Such archives are read
+    in a single forward pass and may come from non-seekable streams.
+    Assets read out of order or left unread when the next part is reached
+    are spooled, to disk past `spool_size`, so `batch_size` bounds them.
+    
+    The manifest is encoded by the datatap registered as `manifest_format`
+    and read back with whichever manifest datatap the archive was written with.
     '''
-    def __init__(self, instream=None, compression=None, **kwargs):
+    def __init__(self, instream=None, compression=None, stream=False, batch_size=None, manifest_format='JSON', **kwargs):
         self.compression = compression
+        self.manifest_format = manifest_format
+        self.stream = stream
+        self.batch_size = batch_size or 1000
         super(TarFileDataTap, self).__init__(instream, **kwargs)
     
     def get_domain(self):
@@ -77,50 +212,104 @@ class TarFileDataTap(DataTap):
     def get_filetap(self, archive, files=None):
         return TarFileTap(archive, files)
     
-    def send(self, fileobj):
-        mode = 'w'
+    def get_mode(self, mode):
+        #stream modes never seek the underlying file
+        if self.stream:
+            mode += '|'
+        elif self.compression:
+            mode += ':'
         if self.compression:
-            mode += ':' + self.compression
-        archive = tarfile.TarFile(fileobj=fileobj, mode=mode)
+            mode += self.compression
+        return mode
+    
+    def get_manifest_datatap(self, name):
+        '''
+        Returns the datatap decoding the manifest or manifest part of that
+        name or None if it isn't one
+        '''
+        for manifest_datatap in MANIFEST_DATATAPS:
+            match = MANIFEST_PART_RE.match(name)
+            if name == 'manifest.%s' % manifest_datatap.extension or (match and match.group(1) == manifest_datatap.extension):
+                return manifest_datatap
+        return None
+    
+    def send(self, fileobj):
+        archive = tarfile.open(fileobj=fileobj, mode=self.get_mode('w'))
         filetap = self.get_filetap(archive)
-        encoded_stream = JSONDataTap(self.item_stream, filetap=filetap) #encode our objects into json
-        if isinstance(encoded_stream, basestring):
-            manifest = encoded_stream
+        manifest_datatap = lookup_datatap(self.manifest_format)
+        if self.stream:
+            item_stream = iter(self.item_stream)
+            index = 0
+            while True:
+                batch = list(islice(item_stream, self.batch_size))
+                if not batch:
+                    break
+                encoded_stream = manifest_datatap(MemoryDataTap(batch), filetap=filetap)
+                filetap.write_stream('manifest-%06d.%s' % (index, manifest_datatap.extension), encoded_stream,
+                                     defer_files=True)
+                index += 1
         else:
-            manifest = ''.join(encoded_stream)
-        
-        manifest_file = WritableTarExtFile(archive, 'manifest.json', manifest)
-        manifest_file.save()
+            encoded_stream = manifest_datatap(self.item_stream, filetap=filetap) #encode our objects
+            filetap.write_stream('manifest.%s' % manifest_datatap.extension, encoded_stream)
         archive.close()
     
     def get_primitive_stream(self, instream):
         #instream is a bytes datatap but we want the file like object it reads
-        mode = 'r'
-        if self.compression:
-            mode += ':' + self.compression
-        archive = tarfile.TarFile(fileobj=instream.item_stream, mode=mode)
-        manifest = None
-        files = {}
-        for tarinfo in archive:
-            if not tarinfo.isreg():
+        archive = tarfile.open(fileobj=instream.item_stream, mode=self.get_mode('r'))
+        if self.stream:
+            return self.get_streamed_primitive_stream(archive)
+        for manifest_datatap in MANIFEST_DATATAPS:
+            name = 'manifest.%s' % manifest_datatap.extension
+            try:
+                manifest = archive.extractfile(name)
+            except KeyError:
                 continue
-            fileobj = archive.extractfile(tarinfo)
-            assert fileobj is not None
-            files[tarinfo.path] = DjangoTarExtFile(fileobj, tarinfo)
-            if tarinfo.name == 'manifest.json':
-                manifest = fileobj
-        if manifest is None:
-            archive.extractfile('manifest.json') #TODO raise a proper exception
-        filetap = self.get_filetap(archive, files)
-        return JSONDataTap(StreamDataTap(manifest), filetap=filetap)
+            if manifest is None:
+                raise KeyError('%s is not a regular file' % name)
+            filetap = self.get_filetap(archive)
+            return manifest_datatap(StreamDataTap(manifest), filetap=filetap)
+        raise KeyError('There is no manifest in the archive')
+    
+    def get_streamed_primitive_stream(self, archive):
+        '''
+        Reads the archive forward. The records of each manifest part are
+        emitted as soon as the part is read and their assets are reached as
+        they are opened. Assets passed over, or left unread when the next part
+        is reached, are spooled, so at most a part's assets are held at once.
+        '''
+        members = (tarinfo for tarinfo in archive if tarinfo.isreg())
+        manifest_info = None
+        for tarinfo in members:
+            if self.get_manifest_datatap(tarinfo.name):
+                manifest_info = tarinfo
+                break
+        if manifest_info is None:
+            raise KeyError('There is no manifest in the archive')
+        while manifest_info is not None:
+            manifest_datatap = self.get_manifest_datatap(manifest_info.name)
+            filetap = StreamedTarFileTap(archive, members, self.get_manifest_datatap)
+            fileobj = archive.extractfile(manifest_info)
+            #the assets are read from the archive while the part is decoded
+            manifest = filetap.spool(iter(lambda: fileobj.read(File.DEFAULT_CHUNK_SIZE), ''))
+            manifest.seek(0)
+            for item in manifest_datatap(StreamDataTap(manifest), filetap=filetap):
+                yield item
+            manifest.close()
+            manifest_info = filetap.finish()
     
     def get_bytes_stream(self, instream):
         return instream
     
     command_option_list = [
         Option('--gzip', action='store_const', const='gz', dest='compression'),
-        Option('--bz', action='store_const', const='bz', dest='compression'),
+        Option('--bz', action='store_const', const='bz2', dest='compression'),
+        Option('--stream', action='store_true', dest='stream', default=False,
+               help='Write manifest parts ahead of their assets, read in a single forward pass'),
+        Option('--batch-size', action='store', type='int', dest='batch_size',
+               help='Number of records per manifest part when streaming'),
+        Option('--manifest-format', action='store', type='choice', dest='manifest_format', default='JSON',
+               choices=[datatap.get_ident() for datatap in MANIFEST_DATATAPS],
+               help='The datatap encoding the manifest'),
     ]
 
 register_datatap('TarFile', TarFileDataTap)
-
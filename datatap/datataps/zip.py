@@ -1,37 +1,261 @@
 import zipfile
-import io
+import os
+import mimetypes
+import time
+import zlib
+import struct
+import tempfile
 from optparse import make_option
 
 from django.core.files.base import File
 
 from datatap.loading import register_datatap, lookup_datatap
 from datatap.datataps.base import DataTap, FileTap
-from datatap.datataps.streams import StreamDataTap, JSONDataTap
+from datatap.datataps.streams import StreamDataTap, MANIFEST_DATATAPS
+
+
+COMPRESS_TYPES = {
+    'store': zipfile.ZIP_STORED,
+    'deflate': zipfile.ZIP_DEFLATED,
+}
+
+#-1 is zlib's default level
+COMPRESSION_LEVELS = range(-1, 10)
+
+#assets that are already compressed gain nothing from deflate but cost cpu
+STORED_EXTENSIONS = frozenset([
+    'jpg', 'jpeg', 'png', 'gif', 'webp', 'mp3', 'mp4', 'm4a', 'm4v', 'mov', 'avi', 'mkv', 'webm', 'ogg', 'ogv',
+    'zip', 'gz', 'tgz', 'bz2', 'xz', 'zst', 'lz4', '7z', 'rar', 'docx', 'xlsx', 'pptx', 'odt',
+])
+STORED_CONTENT_TYPES = ('image/jpeg', 'image/png', 'image/gif', 'image/webp', 'video/', 'audio/mpeg', 'audio/mp4',
+                        'audio/ogg', 'application/zip', 'application/x-gzip', 'application/x-bzip2')
 
 
 class DjangoZipExtFile(File):
-    def __init__(self, zipextfile, zipinfo):
-        #we could try to not load it in all at once, but zipfile's crc checker seems to break
-        self.file = io.BytesIO(zipextfile.read())
+    '''
+    A django file for a zip archive member that is only opened and
+    decompressed as it is read. Seeking backwards reopens the member.
+    '''
+    def __init__(self, filetap, zipinfo):
+        self.filetap = filetap
         self.zipinfo = zipinfo
         self.mode = 'r'
         self.name = zipinfo.filename
         self._size = zipinfo.file_size
+        self._zipextfile = None
+        self._position = 0
+    
+    def _get_file(self):
+        if self._zipextfile is None:
+            self._zipextfile = self.filetap.open_member(self.zipinfo)
+            self._position = 0
+        return self._zipextfile
+    file = property(_get_file)
+    
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+        data = self.file.read(size)
+        self._position += len(data)
+        return data
+    
+    def tell(self):
+        return self._position
+    
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self._size
+        if offset < self._position:
+            self.close()
+        #zip members can only be read forward
+        while self._position < offset:
+            if not self.read(min(offset - self._position, self.DEFAULT_CHUNK_SIZE)):
+                break
+    
+    def close(self):
+        if self._zipextfile is not None:
+            self._zipextfile.close()
+        self._zipextfile = None
+        self._position = 0
+
+class SharedFile(object):
+    '''
+    A read only view of a file object that keeps its own position, allowing
+    several archive members to be read from one file in any interleaving.
+    '''
+    def __init__(self, fileobj, position=0):
+        self.fileobj = fileobj
+        self.position = position
+    
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            self.fileobj.seek(0, os.SEEK_END)
+            offset += self.fileobj.tell()
+        self.position = offset
+    
+    def tell(self):
+        return self.position
+    
+    def read(self, size=-1):
+        self.fileobj.seek(self.position)
+        data = self.fileobj.read(size)
+        self.position += len(data)
+        return data
+    
+    def close(self):
+        pass
+
+class WritableZipExtFile(object):
+    '''
+    A write only file object that streams a single entry into a zip archive.
+    Sizes and the CRC are written in a data descriptor after the entry data
+    so nothing needs to be known or buffered upfront.
+    '''
+    def __init__(self, archive, path, compress_type=None, compress_level=None):
+        self.archive = archive
+        self.zinfo = zipfile.ZipInfo(path, date_time=time.localtime(time.time())[:6])
+        if compress_type is None:
+            compress_type = archive.compression
+        self.zinfo.compress_type = compress_type
+        self.zinfo.external_attr = 0600 << 16
+        self.zinfo.flag_bits |= 0x08
+        self.zinfo.file_size = self.zinfo.compress_size = self.zinfo.CRC = 0
+        self.zinfo.header_offset = archive.fp.tell()
+        archive._writecheck(self.zinfo)
+        archive._didModify = True
+        self.zip64 = archive._allowZip64
+        if compress_type == zipfile.ZIP_DEFLATED:
+            if compress_level is None:
+                compress_level = zlib.Z_DEFAULT_COMPRESSION
+            self.compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -15)
+        else:
+            self.compressor = None
+        self.closed = False
+        archive.fp.write(self.zinfo.FileHeader(self.zip64))
+    
+    def _write_compressed(self, data):
+        if data:
+            self.zinfo.compress_size += len(data)
+            self.archive.fp.write(data)
+    
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if not data:
+            return
+        self.zinfo.file_size += len(data)
+        self.zinfo.CRC = zlib.crc32(data, self.zinfo.CRC) & 0xffffffff
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self._write_compressed(data)
+    
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.compressor is not None:
+            self._write_compressed(self.compressor.flush())
+        zinfo = self.zinfo
+        if not self.zip64 and max(zinfo.file_size, zinfo.compress_size) > zipfile.ZIP64_LIMIT:
+            raise zipfile.LargeZipFile('Filesize would require ZIP64 extensions')
+        fmt = '<LLQQ' if self.zip64 else '<LLLL'
+        self.archive.fp.write(struct.pack(fmt, zipfile._DD_SIGNATURE, zinfo.CRC,
+                                          zinfo.compress_size, zinfo.file_size))
+        self.archive.filelist.append(zinfo)
+        self.archive.NameToInfo[zinfo.filename] = zinfo
 
 class ZipFileTap(FileTap):
-    def __init__(self, archive):
+    #assets larger than this are spooled to disk while another entry is open
+    spool_size = 1024 * 1024
+    chunk_size = 64 * 1024
+    
+    def __init__(self, archive, compression='auto', compression_level=None, store_extensions=None):
+        '''
+        :param compression: How to compress files, `store`, `deflate` or `auto`
+            to store already compressed media and deflate everything else
+        :param compression_level: The zlib compression level, -1 to 9
+        :param store_extensions: The extensions `auto` stores uncompressed,
+            replacing the default extensions and content types
+        '''
         self.archive = archive
+        self.compression = compression
+        self.compression_level = compression_level
+        self.store_content_types = tuple()
+        if store_extensions is None:
+            store_extensions = STORED_EXTENSIONS
+            self.store_content_types = STORED_CONTENT_TYPES
+        self.store_extensions = frozenset(ext.lower().lstrip('.') for ext in store_extensions)
+        self.deferred = None
+    
+    def get_compress_type(self, path):
+        '''
+        Returns the zipfile compress type for the file at path
+        '''
+        if self.compression != 'auto':
+            return COMPRESS_TYPES[self.compression]
+        extension = os.path.splitext(path)[1].lower().lstrip('.')
+        if extension in self.store_extensions:
+            return zipfile.ZIP_STORED
+        content_type = mimetypes.guess_type(path)[0]
+        if content_type and content_type.startswith(self.store_content_types):
+            return zipfile.ZIP_STORED
+        return zipfile.ZIP_DEFLATED
+    
+    def write_stream(self, path, chunks, compress_type=None):
+        '''
+        Streams an iterable of chunks into a new entry of the archive.
+        Files written while the entry is open are spooled and added after.
+        '''
+        self.deferred = list()
+        try:
+            self.write_chunks(path, chunks, compress_type)
+            for spooled, spooled_path in self.deferred:
+                spooled.seek(0)
+                self.write_chunks(spooled_path, iter(lambda: spooled.read(self.chunk_size), ''))
+        finally:
+            for spooled, spooled_path in self.deferred:
+                spooled.close()
+            self.deferred = None
+    
+    def write_chunks(self, path, chunks, compress_type=None):
+        if compress_type is None:
+            compress_type = self.get_compress_type(path)
+        entry = WritableZipExtFile(self.archive, path, compress_type, self.compression_level)
+        for chunk in chunks:
+            entry.write(chunk)
+        entry.close()
     
     def write_file(self, file_obj, path):
-        #TODO write in chunks
         #TODO write in a directory
-        self.archive.writestr(path, file_obj.read())
+        if self.deferred is not None:
+            #an entry is being streamed, hold onto the file until it is done
+            spooled = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+            for chunk in file_obj.chunks(self.chunk_size):
+                spooled.write(chunk)
+            self.deferred.append((spooled, path))
+            return path
+        self.write_chunks(path, file_obj.chunks(self.chunk_size))
         return path
     
+    def open_member(self, zipinfo):
+        '''
+        Opens an archive member for reading with its own file position
+        '''
+        #zipfile reads members from the shared archive file without seeking
+        fp = self.archive.fp
+        self.archive.fp = SharedFile(fp)
+        try:
+            return self.archive.open(zipinfo, 'r')
+        finally:
+            self.archive.fp = fp
+    
     def read_file(self, path, original_path):
-        zipextfile = self.archive.open(path, 'r')
         zipinfo = self.archive.getinfo(path)
-        loaded_file = DjangoZipExtFile(zipextfile, zipinfo)
+        loaded_file = DjangoZipExtFile(self, zipinfo)
         loaded_file.name = original_path
         loaded_file._committed = False
         return loaded_file
@@ -42,7 +266,38 @@ class ZipFileDataTap(DataTap):
     
     FileDT(ZipDT(ModelDT)).write(filename) => write models to filename
     ModelDT(ZipDT(FileDT(filename))) => read from filename into models
+    
+    The manifest is encoded by the datatap registered as `manifest_format`
+    and read back with whichever manifest datatap the archive was written with.
+    
+    The manifest is deflated unless `manifest_compression` is `store`. Assets
+    are compressed by `compression`, where `auto` stores files whose
+    extension or content type marks them as already compressed, like jpegs
+    and mp4s, and deflates everything else.
     '''
+    def __init__(self, instream=None, manifest_format='JSON', manifest_compression='deflate', compression='auto',
+                 compression_level=None, store_extensions=None, **kwargs):
+        '''
+        :param manifest_format: The registered name of the datatap encoding the manifest
+        :param manifest_compression: `store` or `deflate`
+        :param compression: `store`, `deflate` or `auto`
+        :param compression_level: The zlib compression level, -1 to 9
+        :param store_extensions: A list or comma separated string of extensions `auto` stores
+        '''
+        assert manifest_compression in COMPRESS_TYPES, 'Unrecognized compression: %s' % manifest_compression
+        assert compression == 'auto' or compression in COMPRESS_TYPES, 'Unrecognized compression: %s' % compression
+        if isinstance(compression_level, basestring):
+            compression_level = int(compression_level)
+        assert compression_level is None or compression_level in COMPRESSION_LEVELS, \
+            'Unrecognized compression level: %s' % compression_level
+        if isinstance(store_extensions, basestring):
+            store_extensions = [ext.strip() for ext in store_extensions.split(',') if ext.strip()]
+        self.manifest_format = manifest_format
+        self.manifest_compression = manifest_compression
+        self.compression = compression
+        self.compression_level = compression_level
+        self.store_extensions = store_extensions
+        super(ZipFileDataTap, self).__init__(instream, **kwargs)
     
     def get_domain(self):
         if self.instream.domain == 'bytes':
@@ -56,28 +311,49 @@ class ZipFileDataTap(DataTap):
         assert False, 'Unrecognized instream domain: %s' % self.instream.domain
     
     def get_filetap(self, archive):
-        return ZipFileTap(archive)
+        return ZipFileTap(archive, compression=self.compression, compression_level=self.compression_level,
+                          store_extensions=self.store_extensions)
     
     def send(self, fileobj):
-        archive = zipfile.ZipFile(fileobj, 'w')
+        archive = zipfile.ZipFile(fileobj, 'w', allowZip64=True)
         filetap = self.get_filetap(archive)
-        encoded_stream = JSONDataTap(self.item_stream, filetap=filetap) #encode our objects into json
-        if isinstance(encoded_stream, basestring):
-            manifest = encoded_stream
-        else:
-            manifest = ''.join(encoded_stream)
-        archive.writestr('manifest.json', manifest)
+        manifest_datatap = lookup_datatap(self.manifest_format)
+        encoded_stream = manifest_datatap(self.item_stream, filetap=filetap) #encode our objects
+        filetap.write_stream('manifest.%s' % manifest_datatap.extension, encoded_stream,
+                             COMPRESS_TYPES[self.manifest_compression])
         archive.close()
     
     def get_primitive_stream(self, instream):
         #instream is a bytes datatap but we want the file like object it reads
         archive = zipfile.ZipFile(instream.item_stream, 'r')
         filetap = self.get_filetap(archive)
-        return JSONDataTap(StreamDataTap(archive.open('manifest.json')), filetap=filetap)
+        for manifest_datatap in MANIFEST_DATATAPS:
+            name = 'manifest.%s' % manifest_datatap.extension
+            if name in archive.NameToInfo:
+                manifest = filetap.open_member(archive.getinfo(name))
+                return manifest_datatap(StreamDataTap(manifest), filetap=filetap)
+        raise KeyError('There is no manifest in the archive')
     
     def get_bytes_stream(self, instream):
         return instream
     
+    command_option_list = [
+        make_option('--manifest-format', action='store', type='choice', dest='manifest_format', default='JSON',
+                    choices=[datatap.get_ident() for datatap in MANIFEST_DATATAPS],
+                    help='The datatap encoding the manifest'),
+        make_option('--manifest-compression', action='store', type='choice', dest='manifest_compression',
+                    default='deflate', choices=sorted(COMPRESS_TYPES.keys()),
+                    help='How to compress the manifest'),
+        make_option('--compression', action='store', type='choice', dest='compression', default='auto',
+                    choices=['auto'] + sorted(COMPRESS_TYPES.keys()),
+                    help='How to compress assets, auto stores already compressed media and deflates the rest'),
+        make_option('--compression-level', action='store', type='choice', dest='compression_level',
+                    choices=[str(level) for level in COMPRESSION_LEVELS],
+                    help='The zlib compression level, -1 to 9'),
+        make_option('--store-extensions', action='store', type='string', dest='store_extensions',
+                    help='Comma separated extensions that auto compression stores uncompressed'),
+    ]
+    
     #def detect_originating_datatap(self):
     #    return lookup_datatap(self.zipfile.read('originator.txt'))
 
@@ -1,5 +1,11 @@
 import json
 import types
+import codecs
+import zlib
+import struct
+import decimal
+import datetime
+from json.decoder import WHITESPACE
 
 from django.utils.functional import Promise
 from django.core.files import File
@@ -8,13 +14,71 @@ try:
 except ImportError:
     from django.utils.encoding import force_unicode as force_text
 from django.core.serializers.json import DjangoJSONEncoder
+try:
+    from django.utils.timezone import utc
+except ImportError: #django 1.3
+    utc = None
+
+
+#number of bytes to read at a time when decoding a stream
+DECODE_CHUNK_SIZE = 64 * 1024
+
+
+class IteratorArray(list):
+    '''
+    A list stand-in for an iterator so that ``iterencode`` emits the array
+    as the iterator is consumed instead of materializing it first.
+    '''
+    def __init__(self, iterable):
+        super(IteratorArray, self).__init__()
+        self.iterator = iter(iterable)
+        self.peeked = list()
+    
+    def __nonzero__(self):
+        #the encoder checks for an empty list before iterating
+        if not self.peeked:
+            for item in self.iterator:
+                self.peeked.append(item)
+                break
+        return bool(self.peeked)
+    
+    def __iter__(self):
+        while self.peeked:
+            yield self.peeked.pop()
+        for item in self.iterator:
+            yield item
 
+class FoundIterator(Exception):
+    pass
 
 class DataTapJSONEncoder(DjangoJSONEncoder):
     def __init__(self, *args, **kwargs):
         self.filetap = kwargs.pop('filetap', None)
+        self.one_shot = False
         super(DataTapJSONEncoder, self).__init__(*args, **kwargs)
     
+    def iterencode(self, o, _one_shot=False):
+        if _one_shot and self.filetap is None:
+            #encode() takes the c encoder until it meets an iterator, which
+            #it would consume without writing through IteratorArray. Files
+            #written to a filetap before the iterator would be written twice.
+            self.one_shot = True
+            try:
+                return super(DataTapJSONEncoder, self).iterencode(o, _one_shot=True)
+            except FoundIterator:
+                pass
+            finally:
+                self.one_shot = False
+        return super(DataTapJSONEncoder, self).iterencode(o, _one_shot=False)
+    
+    def iterencode_lines(self, items):
+        '''
+        Encodes each item on a line of its own, JSON escapes any newline
+        within strings
+        '''
+        for item in items:
+            yield ''.join(self.iterencode(item)) + '\n'
+    
     def default(self, obj):
         if isinstance(obj, set):
             return list(obj)
@@ -29,11 +93,11 @@ class DataTapJSONEncoder(DjangoJSONEncoder):
         if isinstance(obj, Promise):
             return force_text(obj)
         
-        #TODO can we iterate through this instead?
-        if isinstance(obj, types.GeneratorType):
-            return list(obj)
-        if hasattr(obj, 'next') and hasattr(obj, '__iter__'): #an iterator:
-            return list(obj)
+        #emitted as the encoder consumes them
+        if isinstance(obj, types.GeneratorType) or (hasattr(obj, 'next') and hasattr(obj, '__iter__')): #an iterator
+            if self.one_shot:
+                raise FoundIterator
+            return IteratorArray(obj)
         
         return super(DataTapJSONEncoder, self).default(obj)
 
@@ -50,3 +114,757 @@ class DataTapJSONDecoder(json.JSONDecoder):
             else:
                 return dct['path']
         return dct
+    
+    def iterdecode_lines(self, stream, chunk_size=None):
+        '''
+        Decodes a file like object with a JSON document per line, yielding
+        each as soon as its line has been read. Blank lines are skipped.
+        
+        :param stream: A file like object with a read method
+        :param chunk_size: The number of bytes to read at a time
+        '''
+        chunk_size = chunk_size or DECODE_CHUNK_SIZE
+        #the chunks of a partial line are joined once its newline arrives
+        pieces = list()
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            pieces.append(chunk)
+            if '\n' not in chunk:
+                continue
+            lines = ''.join(pieces).split('\n')
+            #the last line may continue in the next chunk
+            pieces = [lines.pop()]
+            for line in lines:
+                if line.strip():
+                    yield self.decode(line.decode('utf-8'))
+        line = ''.join(pieces)
+        if line.strip():
+            yield self.decode(line.decode('utf-8'))
+    
+    def iterdecode(self, stream, chunk_size=None):
+        '''
+        Incrementally decodes a file like object containing a JSON array,
+        yielding each top level element as soon as it has been read.
+        Only one element and one chunk are held in memory at a time.
+        
+        :param stream: A file like object with a read method
+        :param chunk_size: The number of bytes to read at a time
+        '''
+        chunk_size = chunk_size or DECODE_CHUNK_SIZE
+        reader = codecs.getincrementaldecoder('utf-8')()
+        buf = u''
+        pos = 0
+        eof = False
+        read_size = chunk_size
+        state = 'start'
+        while True:
+            pos = WHITESPACE.match(buf, pos).end()
+            if pos < len(buf):
+                char = buf[pos]
+                if state == 'start':
+                    if char != '[':
+                        #not an array, decode the whole document
+                        remainder = buf[pos:] + reader.decode(stream.read(), True)
+                        for item in self.decode(remainder):
+                            yield item
+                        return
+                    pos += 1
+                    state = 'first'
+                    continue
+                if char == ']' and state in ('first', 'delimiter'):
+                    return
+                if state == 'delimiter':
+                    if char != ',':
+                        raise ValueError('Expecting , delimiter at: %r' % buf[pos:pos+20])
+                    pos += 1
+                    state = 'value'
+                    continue
+                try:
+                    obj, end = self.raw_decode(buf, pos)
+                except ValueError:
+                    if eof:
+                        raise
+                    end = None
+                #a value is only complete once its delimiter has been read,
+                #a number like 1 in "[1" or "[1." may continue in the next chunk
+                if end is not None:
+                    after = WHITESPACE.match(buf, end).end()
+                    if not eof and (after == len(buf) or buf[after] not in ',]'):
+                        end = None
+                if end is not None:
+                    yield obj
+                    pos = end
+                    state = 'delimiter'
+                    read_size = chunk_size
+                    continue
+                #grow the read so large elements are not rescanned too often
+                read_size *= 2
+            elif eof:
+                raise ValueError('Unexpected end of JSON stream')
+            chunk = stream.read(read_size)
+            eof = not chunk
+            buf = buf[pos:] + reader.decode(chunk, eof)
+            pos = 0
+
+BINARY_MAGIC = 'DTB\x01'
+COLUMNAR_MAGIC = 'DTC\x01'
+DEFAULT_ROW_GROUP_SIZE = 10000
+#number of bytes gathered before the binary encoder yields a chunk
+ENCODE_CHUNK_SIZE = 64 * 1024
+SUBCLASSED_TYPES = (bool, int, long, float, unicode, str, list, tuple, dict,
+                    datetime.datetime, datetime.date, datetime.time, decimal.Decimal)
+
+def encode_varint(value, out):
+    while value > 0x7f:
+        out.append(chr(0x80 | (value & 0x7f)))
+        value >>= 7
+    out.append(chr(value))
+
+def decode_varint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = ord(data[pos])
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+class FileReference(object):
+    def __init__(self, path, storage_path):
+        self.path = path
+        self.storage_path = storage_path
+
+class DataTapBinaryEncoder(object):
+    '''
+    Encodes primitives as length prefixed binary records. Each record is a
+    tag byte, the varint length of its payload and the payload.
+    
+    Records of models are written as rows of a table listing the model and
+    its field names, which is written once before the first row using it.
+    Values carry a one byte type tag, dates, times and decimals are stored
+    natively and files are stored through the filetap.
+    '''
+    def __init__(self, filetap=None):
+        self.filetap = filetap
+        self.tables = dict()
+        self.value_encoders = {
+            type(None): lambda value, out: out.append('0'),
+            bool: self.encode_bool,
+            int: self.encode_int,
+            long: self.encode_int,
+            float: self.encode_float,
+            unicode: self.encode_text,
+            str: self.encode_text,
+            list: self.encode_list,
+            tuple: self.encode_list,
+            dict: self.encode_dict,
+            datetime.datetime: self.encode_datetime,
+            datetime.date: self.encode_date,
+            datetime.time: self.encode_time,
+            decimal.Decimal: self.encode_decimal,
+            FileReference: self.encode_file_reference,
+        }
+    
+    magic = BINARY_MAGIC
+    
+    def iterencode(self, items):
+        out = [self.magic]
+        size = len(self.magic)
+        for record in self.encode_records(items):
+            out.append(record)
+            size += len(record)
+            if size >= ENCODE_CHUNK_SIZE:
+                yield ''.join(out)
+                out = list()
+                size = 0
+        if out:
+            yield ''.join(out)
+    
+    def encode_records(self, items):
+        for item in items:
+            yield self.encode_item(item)
+    
+    def encode_item(self, item):
+        out = list()
+        if self.is_row(item):
+            fields = item['fields']
+            key = (item['model'], tuple(fields))
+            if key not in self.tables:
+                table = list()
+                self.encode_text(key[0], table)
+                encode_varint(len(fields), table)
+                for name in key[1]:
+                    self.encode_text(name, table)
+                #the table id is implied by the order of the table records
+                self.tables[key] = len(self.tables)
+                self.frame('M', table, out)
+            payload = list()
+            encode_varint(self.tables[key], payload)
+            self.encode_value(item['pk'], payload)
+            for value in fields.itervalues():
+                self.encode_value(value, payload)
+            self.frame('R', payload, out)
+        else:
+            payload = list()
+            self.encode_value(item, payload)
+            self.frame('V', payload, out)
+        return ''.join(out)
+    
+    def is_row(self, item):
+        return (isinstance(item, dict) and len(item) == 3 and isinstance(item.get('fields'), dict) and
+                isinstance(item.get('model'), basestring) and 'pk' in item)
+    
+    def frame(self, tag, payload, out):
+        payload = ''.join(payload)
+        out.append(tag)
+        encode_varint(len(payload), out)
+        out.append(payload)
+    
+    def encode_value(self, value, out):
+        encoder = self.value_encoders.get(type(value))
+        if encoder is None:
+            #subclasses such as SafeUnicode, datetime before date
+            for value_type in SUBCLASSED_TYPES:
+                if isinstance(value, value_type):
+                    encoder = self.value_encoders[value_type]
+                    break
+            else:
+                return self.encode_value(self.default(value), out)
+        encoder(value, out)
+    
+    def default(self, obj):
+        if isinstance(obj, File):
+            if self.filetap:
+                desired_path = getattr(obj, 'name', None) or getattr(obj, 'path')
+                return FileReference(desired_path, self.filetap.write_file(obj, desired_path))
+            return obj.name
+        if isinstance(obj, Promise):
+            return force_text(obj)
+        #sets and iterators, such as many to many values
+        if hasattr(obj, '__iter__'):
+            return list(obj)
+        raise TypeError('%r is not binary serializable' % (obj,))
+    
+    def encode_bool(self, value, out):
+        out.append('T' if value else 'F')
+    
+    def encode_int(self, value, out):
+        out.append('i')
+        #zigzag so that small negative numbers stay short
+        encode_varint(value * 2 if value >= 0 else -value * 2 - 1, out)
+    
+    def encode_float(self, value, out):
+        out.append('f')
+        out.append(struct.pack('>d', value))
+    
+    def encode_text(self, value, out):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        out.append('s')
+        encode_varint(len(value), out)
+        out.append(value)
+    
+    def encode_list(self, value, out):
+        out.append('l')
+        encode_varint(len(value), out)
+        for item in value:
+            self.encode_value(item, out)
+    
+    def encode_dict(self, value, out):
+        out.append('d')
+        encode_varint(len(value), out)
+        for key, item in value.iteritems():
+            self.encode_value(key, out)
+            self.encode_value(item, out)
+    
+    def encode_parts(self, tag, parts, out):
+        out.append(tag)
+        for part in parts:
+            encode_varint(part, out)
+    
+    def encode_date(self, value, out):
+        self.encode_parts('D', (value.year, value.month, value.day), out)
+    
+    def encode_time(self, value, out):
+        if value.utcoffset() is not None:
+            raise ValueError("Binary streams can't represent timezone-aware times.")
+        self.encode_parts('H', (value.hour, value.minute, value.second, value.microsecond), out)
+    
+    def encode_datetime(self, value, out):
+        tag = 'W'
+        if value.tzinfo is not None and value.utcoffset() is not None:
+            value = (value - value.utcoffset()).replace(tzinfo=None)
+            tag = 'Z'
+        self.encode_parts(tag, (value.year, value.month, value.day, value.hour,
+                                value.minute, value.second, value.microsecond), out)
+    
+    def encode_decimal(self, value, out):
+        value = str(value)
+        out.append('c')
+        encode_varint(len(value), out)
+        out.append(value)
+    
+    def encode_file_reference(self, value, out):
+        out.append('A')
+        self.encode_text(value.path, out)
+        self.encode_text(value.storage_path, out)
+
+class DataTapBinaryDecoder(object):
+    '''
+    Decodes the records written by `DataTapBinaryEncoder`
+    '''
+    def __init__(self, filetap=None):
+        self.filetap = filetap
+        self.tables = list()
+        self.value_decoders = {
+            '0': lambda data, pos: (None, pos),
+            'T': lambda data, pos: (True, pos),
+            'F': lambda data, pos: (False, pos),
+            'i': self.decode_int,
+            'f': self.decode_float,
+            's': self.decode_text,
+            'l': self.decode_list,
+            'd': self.decode_dict,
+            'D': self.decode_date,
+            'H': self.decode_time,
+            'W': self.decode_datetime,
+            'Z': self.decode_datetime,
+            'c': self.decode_decimal,
+            'A': self.decode_file_reference,
+        }
+    
+    magic = BINARY_MAGIC
+    
+    def iterdecode(self, stream, chunk_size=None):
+        '''
+        Yields the items of a file like object as soon as their record has
+        been read
+        
+        :param stream: A file like object with a read method
+        :param chunk_size: The number of bytes to read at a time
+        '''
+        for tag, record in self.iterrecords(stream, chunk_size):
+            for item in self.decode_record(tag, record):
+                yield item
+    
+    def iterrecords(self, stream, chunk_size=None):
+        chunk_size = chunk_size or DECODE_CHUNK_SIZE
+        buf = ''
+        while len(buf) < len(self.magic):
+            chunk = stream.read(len(self.magic) - len(buf))
+            if not chunk:
+                break
+            buf += chunk
+        if buf != self.magic:
+            raise ValueError('Not a %s stream' % type(self).__name__)
+        buf = ''
+        pos = 0
+        while True:
+            #a tag and a varint length of at most 10 bytes
+            if len(buf) - pos < 11:
+                buf = buf[pos:]
+                pos = 0
+                while len(buf) < 11:
+                    chunk = stream.read(chunk_size)
+                    if not chunk:
+                        break
+                    buf += chunk
+                if not buf:
+                    return
+            tag = buf[pos]
+            try:
+                length, start = decode_varint(buf, pos + 1)
+            except IndexError:
+                raise ValueError('Unexpected end of binary stream')
+            end = start + length
+            while len(buf) < end:
+                chunk = stream.read(max(chunk_size, end - len(buf)))
+                if not chunk:
+                    raise ValueError('Unexpected end of binary stream')
+                buf += chunk
+            yield tag, buf[start:end]
+            pos = end
+    
+    def decode_record(self, tag, record):
+        if tag == 'M':
+            self.decode_table(record)
+            return ()
+        if tag == 'R':
+            return (self.decode_row(record),)
+        if tag == 'V':
+            return (self.decode_value(record, 0)[0],)
+        raise ValueError('Unrecognized record: %r' % tag)
+    
+    def decode_table(self, record):
+        model, pos = self.decode_value(record, 0)
+        count, pos = decode_varint(record, pos)
+        names = list()
+        for i in range(count):
+            name, pos = self.decode_value(record, pos)
+            names.append(name)
+        self.tables.append((model, names))
+    
+    def decode_row(self, record):
+        table, pos = decode_varint(record, 0)
+        model, names = self.tables[table]
+        pk, pos = self.decode_value(record, pos)
+        fields = dict()
+        for name in names:
+            fields[name], pos = self.decode_value(record, pos)
+        return {'model': model, 'pk': pk, 'fields': fields}
+    
+    def decode_value(self, data, pos):
+        return self.value_decoders[data[pos]](data, pos + 1)
+    
+    def decode_int(self, data, pos):
+        value, pos = decode_varint(data, pos)
+        return (value >> 1 if not value & 1 else -((value + 1) >> 1)), pos
+    
+    def decode_float(self, data, pos):
+        return struct.unpack('>d', data[pos:pos + 8])[0], pos + 8
+    
+    def decode_text(self, data, pos):
+        length, pos = decode_varint(data, pos)
+        return data[pos:pos + length].decode('utf-8'), pos + length
+    
+    def decode_list(self, data, pos):
+        count, pos = decode_varint(data, pos)
+        items = list()
+        for i in range(count):
+            item, pos = self.decode_value(data, pos)
+            items.append(item)
+        return items, pos
+    
+    def decode_dict(self, data, pos):
+        count, pos = decode_varint(data, pos)
+        items = dict()
+        for i in range(count):
+            key, pos = self.decode_value(data, pos)
+            items[key], pos = self.decode_value(data, pos)
+        return items, pos
+    
+    def decode_parts(self, data, pos, count):
+        parts = list()
+        for i in range(count):
+            part, pos = decode_varint(data, pos)
+            parts.append(part)
+        return parts, pos
+    
+    def decode_date(self, data, pos):
+        parts, pos = self.decode_parts(data, pos, 3)
+        return datetime.date(*parts), pos
+    
+    def decode_time(self, data, pos):
+        parts, pos = self.decode_parts(data, pos, 4)
+        return datetime.time(*parts), pos
+    
+    def decode_datetime(self, data, pos):
+        tag = data[pos - 1]
+        parts, pos = self.decode_parts(data, pos, 7)
+        value = datetime.datetime(*parts)
+        if tag == 'Z' and utc is not None:
+            value = value.replace(tzinfo=utc)
+        return value, pos
+    
+    def decode_decimal(self, data, pos):
+        length, pos = decode_varint(data, pos)
+        return decimal.Decimal(data[pos:pos + length]), pos + length
+    
+    def decode_file_reference(self, data, pos):
+        path, pos = self.decode_value(data, pos)
+        storage_path, pos = self.decode_value(data, pos)
+        if self.filetap:
+            return self.filetap.read_file(storage_path, path), pos
+        return path, pos
+
+class DataTapColumnarEncoder(DataTapBinaryEncoder):
+    '''
+    Encodes consecutive model records with the same fields as row groups of
+    up to `row_group_size` rows. Each column of a group is stored as a typed
+    array (integers, floats, booleans, text, dates and naive datetimes, other
+    values as binary values) behind a bitmap of its nulls, compressed with
+    zlib at `compression_level` and headed by its null count and, for typed
+    columns, its min and max values. Other primitives are binary records.
+    '''
+    magic = COLUMNAR_MAGIC
+    
+    def __init__(self, filetap=None, row_group_size=None, compression_level=None):
+        super(DataTapColumnarEncoder, self).__init__(filetap=filetap)
+        self.row_group_size = row_group_size or DEFAULT_ROW_GROUP_SIZE
+        self.compression_level = 6 if compression_level is None else compression_level
+        self.column_encoders = {
+            'i': self.encode_int_column,
+            'f': self.encode_float_column,
+            'b': self.encode_bool_column,
+            's': self.encode_text_column,
+            'D': self.encode_date_column,
+            'W': self.encode_datetime_column,
+            'x': self.encode_mixed_column,
+        }
+    
+    def encode_records(self, items):
+        key = None
+        rows = list()
+        for item in items:
+            if not self.is_row(item):
+                if rows:
+                    yield self.encode_row_group(key, rows)
+                    key, rows = None, list()
+                yield self.encode_item(item)
+                continue
+            item_key = (item['model'], tuple(item['fields']))
+            if rows and (item_key != key or len(rows) >= self.row_group_size):
+                yield self.encode_row_group(key, rows)
+                rows = list()
+            key = item_key
+            rows.append(item)
+        if rows:
+            yield self.encode_row_group(key, rows)
+    
+    def encode_row_group(self, key, rows):
+        model, names = key
+        payload = list()
+        self.encode_text(model, payload)
+        encode_varint(len(rows), payload)
+        encode_varint(len(names) + 1, payload)
+        self.encode_column(u'pk', [row['pk'] for row in rows], payload)
+        for name in names:
+            self.encode_column(name, [row['fields'][name] for row in rows], payload)
+        out = list()
+        self.frame('G', payload, out)
+        return ''.join(out)
+    
+    def get_column_type(self, values):
+        column_type = None
+        for value in values:
+            if value is None:
+                continue
+            value_type = type(value)
+            if value_type is bool:
+                tag = 'b'
+            elif value_type in (int, long):
+                tag = 'i'
+            elif value_type is float:
+                tag = 'f'
+            elif isinstance(value, basestring):
+                tag = 's'
+            elif value_type is datetime.date:
+                tag = 'D'
+            elif value_type is datetime.datetime and value.tzinfo is None:
+                tag = 'W'
+            else:
+                return 'x'
+            if column_type is not None and tag != column_type:
+                return 'x'
+            column_type = tag
+        return column_type or 'x'
+    
+    def encode_column(self, name, values, out):
+        column_type = self.get_column_type(values)
+        present = [value for value in values if value is not None]
+        self.encode_text(name, out)
+        out.append(column_type)
+        encode_varint(len(values) - len(present), out)
+        if len(present) < len(values):
+            nulls = bytearray((len(values) + 7) // 8)
+            for index, value in enumerate(values):
+                if value is None:
+                    nulls[index // 8] |= 1 << (index % 8)
+            out.append(str(nulls))
+        if column_type == 'x':
+            data = self.encode_mixed_column(values)
+        else:
+            if present:
+                self.encode_value(min(present), out)
+                self.encode_value(max(present), out)
+            data = self.column_encoders[column_type](present)
+        compressed = zlib.compress(data, self.compression_level)
+        if len(compressed) < len(data):
+            out.append('z')
+            data = compressed
+        else:
+            out.append('r')
+        encode_varint(len(data), out)
+        out.append(data)
+    
+    def encode_int_column(self, values):
+        out = list()
+        for value in values:
+            encode_varint(value * 2 if value >= 0 else -value * 2 - 1, out)
+        return ''.join(out)
+    
+    def encode_float_column(self, values):
+        return struct.pack('>%dd' % len(values), *values)
+    
+    def encode_bool_column(self, values):
+        return ''.join('\x01' if value else '\x00' for value in values)
+    
+    def encode_text_column(self, values):
+        values = [value.encode('utf-8') if isinstance(value, unicode) else value for value in values]
+        out = list()
+        for value in values:
+            encode_varint(len(value), out)
+        out.extend(values)
+        return ''.join(out)
+    
+    def encode_date_column(self, values):
+        return self.encode_int_column([value.toordinal() for value in values])
+    
+    def encode_datetime_column(self, values):
+        return self.encode_int_column([
+            (value.toordinal() * 86400 + value.hour * 3600 + value.minute * 60 + value.second) * 1000000 + value.microsecond
+            for value in values])
+    
+    def encode_mixed_column(self, values):
+        #nulls are kept so that other values need no bitmap
+        out = list()
+        for value in values:
+            self.encode_value(value, out)
+        return ''.join(out)
+
+class ColumnBatch(object):
+    '''
+    A row group of a model, `columns` maps column names to lists of values
+    and `stats` maps them to (null count, min, max)
+    '''
+    def __init__(self, model, names, columns, stats):
+        self.model = model
+        self.names = names
+        self.columns = columns
+        self.stats = stats
+    
+    def __len__(self):
+        return len(self.columns[u'pk'])
+    
+    def __iter__(self):
+        field_names = self.names[1:]
+        field_columns = [self.columns[name] for name in field_names]
+        for index, pk in enumerate(self.columns[u'pk']):
+            yield {
+                'model': self.model,
+                'pk': pk,
+                'fields': dict((name, column[index]) for name, column in zip(field_names, field_columns)),
+            }
+
+class DataTapColumnarDecoder(DataTapBinaryDecoder):
+    '''
+    Decodes the records written by `DataTapColumnarEncoder`
+    '''
+    magic = COLUMNAR_MAGIC
+    
+    def __init__(self, filetap=None):
+        super(DataTapColumnarDecoder, self).__init__(filetap=filetap)
+        self.column_decoders = {
+            'i': self.decode_int_column,
+            'f': self.decode_float_column,
+            'b': self.decode_bool_column,
+            's': self.decode_text_column,
+            'D': self.decode_date_column,
+            'W': self.decode_datetime_column,
+        }
+    
+    def iterbatches(self, stream, chunk_size=None):
+        '''
+        Yields the row groups of a file like object as `ColumnBatch` objects
+        and other primitives as they are
+        '''
+        for tag, record in self.iterrecords(stream, chunk_size):
+            if tag == 'G':
+                yield self.decode_row_group(record)
+            else:
+                for item in super(DataTapColumnarDecoder, self).decode_record(tag, record):
+                    yield item
+    
+    def decode_record(self, tag, record):
+        if tag == 'G':
+            return self.decode_row_group(record)
+        return super(DataTapColumnarDecoder, self).decode_record(tag, record)
+    
+    def decode_row_group(self, record):
+        model, pos = self.decode_value(record, 0)
+        count, pos = decode_varint(record, pos)
+        num_columns, pos = decode_varint(record, pos)
+        names = list()
+        columns = dict()
+        stats = dict()
+        for i in range(num_columns):
+            name, pos = self.decode_value(record, pos)
+            column_type = record[pos]
+            null_count, pos = decode_varint(record, pos + 1)
+            nulls = None
+            if null_count:
+                nulls = bytearray(record[pos:pos + (count + 7) // 8])
+                pos += len(nulls)
+            minimum = maximum = None
+            if column_type != 'x' and null_count < count:
+                minimum, pos = self.decode_value(record, pos)
+                maximum, pos = self.decode_value(record, pos)
+            compression = record[pos]
+            length, pos = decode_varint(record, pos + 1)
+            data = record[pos:pos + length]
+            pos += length
+            if compression == 'z':
+                data = zlib.decompress(data)
+            if column_type == 'x':
+                values = self.decode_mixed_column(data, count)
+            else:
+                present = self.column_decoders[column_type](data, count - null_count)
+                if nulls is None:
+                    values = present
+                else:
+                    present = iter(present)
+                    values = [None if nulls[index // 8] & (1 << (index % 8)) else present.next()
+                              for index in range(count)]
+            names.append(name)
+            columns[name] = values
+            stats[name] = (null_count, minimum, maximum)
+        return ColumnBatch(model, names, columns, stats)
+    
+    def decode_int_column(self, data, count):
+        values = list()
+        pos = 0
+        for i in range(count):
+            value, pos = decode_varint(data, pos)
+            values.append(value >> 1 if not value & 1 else -((value + 1) >> 1))
+        return values
+    
+    def decode_float_column(self, data, count):
+        return list(struct.unpack('>%dd' % count, data))
+    
+    def decode_bool_column(self, data, count):
+        return [byte == '\x01' for byte in data]
+    
+    def decode_text_column(self, data, count):
+        lengths = list()
+        pos = 0
+        for i in range(count):
+            length, pos = decode_varint(data, pos)
+            lengths.append(length)
+        values = list()
+        for length in lengths:
+            values.append(data[pos:pos + length].decode('utf-8'))
+            pos += length
+        return values
+    
+    def decode_date_column(self, data, count):
+        return [datetime.date.fromordinal(value) for value in self.decode_int_column(data, count)]
+    
+    def decode_datetime_column(self, data, count):
+        values = list()
+        for value in self.decode_int_column(data, count):
+            seconds, microsecond = divmod(value, 1000000)
+            days, seconds = divmod(seconds, 86400)
+            values.append(datetime.datetime.fromordinal(days) + datetime.timedelta(seconds=seconds, microseconds=microsecond))
+        return values
+    
+    def decode_mixed_column(self, data, count):
+        values = list()
+        pos = 0
+        for i in range(count):
+            value, pos = self.decode_value(data, pos)
+            values.append(value)
+        return values
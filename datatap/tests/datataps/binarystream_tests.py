@@ -0,0 +1,87 @@
+from io import BytesIO
+import datetime
+import decimal
+import zipfile
+
+from django.utils import unittest
+from django.core.files.base import ContentFile as BaseContentFile
+from django.contrib.contenttypes.models import ContentType
+
+from datatap.datataps import StreamDataTap, JSONDataTap, BinaryDataTap, MemoryDataTap, ModelDataTap, ZipFileDataTap
+from datatap.datataps.tarfile import TarFileDataTap
+from datatap.encoders import utc
+
+
+class ContentFile(BaseContentFile): #for ease with Django 1.3
+    def __init__(self, content, name=None):
+        super(ContentFile, self).__init__(content)
+        self.name = name
+
+class BinaryDataTapTestCase(unittest.TestCase):
+    def encode(self, items, **kwargs):
+        out_stream = BytesIO()
+        tap = BinaryDataTap(instream=MemoryDataTap(items), **kwargs)
+        tap.send(out_stream)
+        tap.close()
+        return out_stream.getvalue()
+    
+    def decode(self, payload, **kwargs):
+        tap = BinaryDataTap(instream=StreamDataTap(BytesIO(payload)), **kwargs)
+        items = list(tap)
+        tap.close()
+        return items
+    
+    def test_roundtrip_values(self):
+        items = [
+            None, True, False, 0, -1, 2 ** 70, -2 ** 70, 1.5, u'item\xe9', [1, [2, u'three']], {u'key': {u'nested': None}},
+            datetime.date(2013, 1, 2), datetime.time(3, 4, 5, 6), datetime.datetime(2013, 1, 2, 3, 4, 5, 6),
+            decimal.Decimal('-12.340'),
+        ]
+        if utc is not None:
+            items.append(datetime.datetime(2013, 1, 2, 3, 4, 5, tzinfo=utc))
+        self.assertEqual(self.decode(self.encode(items)), items)
+        self.assertEqual(self.decode(self.encode(items), chunk_size=1), items)
+    
+    def test_aware_time(self):
+        if utc is None:
+            return
+        self.assertRaises(ValueError, self.encode, [datetime.time(3, 4, tzinfo=utc)])
+    
+    def test_field_names_written_once(self):
+        items = [{
+            'model': 'app.model',
+            'pk': i,
+            'fields': {'name': u'item%s' % i, 'created': datetime.date(2013, 1, 1)},
+        } for i in range(100)]
+        payload = self.encode(items)
+        self.assertEqual(payload.count('created'), 1)
+        self.assertEqual(self.decode(payload, chunk_size=7), items)
+        
+        json_stream = BytesIO()
+        JSONDataTap(MemoryDataTap(items)).send(json_stream)
+        self.assertTrue(len(payload) < len(json_stream.getvalue()) / 2)
+    
+    def test_model_roundtrip(self):
+        payload = self.encode(list(ModelDataTap([ContentType])))
+        items = list(ModelDataTap(BinaryDataTap(StreamDataTap(BytesIO(payload)))))
+        self.assertEqual([item.object for item in items], list(ContentType.objects.all()))
+    
+    def test_zip_manifest(self):
+        payload = [{'test': u'item', 'readme': ContentFile('Just some file, move along', 'readme.txt')}]
+        archive_stream = BytesIO()
+        ZipFileDataTap(MemoryDataTap(payload), manifest_format='Binary').send(archive_stream)
+        self.assertTrue('manifest.bin' in zipfile.ZipFile(archive_stream).namelist())
+        
+        items = list(ZipFileDataTap(StreamDataTap(archive_stream)))
+        self.assertEqual(items[0]['test'], u'item')
+        self.assertEqual(items[0]['readme'].read(), 'Just some file, move along')
+    
+    def test_tar_stream_manifest(self):
+        payload = [{'index': i, 'readme': ContentFile('file %s' % i, 'readme%s.txt' % i)} for i in range(5)]
+        archive_stream = BytesIO()
+        TarFileDataTap(MemoryDataTap(payload), stream=True, batch_size=2, manifest_format='Binary').send(archive_stream)
+        archive_stream.seek(0)
+        
+        items = list(TarFileDataTap(StreamDataTap(archive_stream), stream=True))
+        self.assertEqual([item['index'] for item in items], range(5))
+        self.assertEqual(items[3]['readme'].read(), 'file 3')
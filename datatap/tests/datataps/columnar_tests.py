@@ -0,0 +1,64 @@
+from io import BytesIO
+import datetime
+import decimal
+
+from django.utils import unittest
+from django.contrib.contenttypes.models import ContentType
+
+from datatap.datataps import StreamDataTap, JSONDataTap, ColumnarDataTap, MemoryDataTap, ModelDataTap, ZipFileDataTap
+
+
+class ColumnarDataTapTestCase(unittest.TestCase):
+    def encode(self, items, **kwargs):
+        out_stream = BytesIO()
+        tap = ColumnarDataTap(instream=MemoryDataTap(items), **kwargs)
+        tap.send(out_stream)
+        tap.close()
+        return out_stream.getvalue()
+    
+    def get_rows(self, count):
+        return [{
+            'model': 'app.model',
+            'pk': i,
+            'fields': {
+                'name': u'item%s' % (i % 7) if i % 5 else None,
+                'price': decimal.Decimal('%s.25' % i),
+                'ratio': i / 4.0,
+                'active': bool(i % 2),
+                'created': datetime.date(2013, 1, 1) + datetime.timedelta(days=i),
+                'modified': datetime.datetime(2013, 1, 1, 12, 30, 0, i),
+                'tags': [i, u'tag'],
+            },
+        } for i in range(count)]
+    
+    def test_roundtrip(self):
+        items = [u'header'] + self.get_rows(25) + [{'model': 'app.other', 'pk': u'a', 'fields': {}}, 5]
+        payload = self.encode(items, row_group_size=10)
+        tap = ColumnarDataTap(StreamDataTap(BytesIO(payload)), chunk_size=16)
+        self.assertEqual(list(tap), items)
+    
+    def test_column_batches(self):
+        payload = self.encode(self.get_rows(25), row_group_size=10)
+        batches = list(ColumnarDataTap(StreamDataTap(BytesIO(payload))).get_column_batches())
+        self.assertEqual([len(batch) for batch in batches], [10, 10, 5])
+        self.assertEqual(batches[1].columns[u'pk'], range(10, 20))
+        self.assertEqual(batches[1].stats[u'pk'], (0, 10, 19))
+        self.assertEqual(batches[0].stats[u'name'], (2, u'item0', u'item6'))
+        self.assertEqual(batches[2].stats[u'created'], (0, datetime.date(2013, 1, 21), datetime.date(2013, 1, 25)))
+    
+    def test_smaller_than_json(self):
+        items = self.get_rows(1000)
+        json_stream = BytesIO()
+        JSONDataTap(MemoryDataTap(items)).send(json_stream)
+        self.assertTrue(len(self.encode(items)) < len(json_stream.getvalue()) / 4)
+    
+    def test_model_roundtrip(self):
+        payload = self.encode(list(ModelDataTap([ContentType])))
+        items = list(ModelDataTap(ColumnarDataTap(StreamDataTap(BytesIO(payload)))))
+        self.assertEqual([item.object for item in items], list(ContentType.objects.all()))
+    
+    def test_zip_manifest(self):
+        items = self.get_rows(3)
+        archive_stream = BytesIO()
+        ZipFileDataTap(MemoryDataTap(items), manifest_format='Columnar').send(archive_stream)
+        self.assertEqual(list(ZipFileDataTap(StreamDataTap(archive_stream))), items)
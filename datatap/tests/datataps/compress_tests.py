@@ -0,0 +1,82 @@
+from io import BytesIO
+import bz2
+import gzip
+
+from django.utils import unittest
+
+from datatap.datataps import StreamDataTap, JSONDataTap, CompressDataTap, MemoryDataTap
+from datatap.datataps.compress import CODECS
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+class CompressDataTapTestCase(unittest.TestCase):
+    def get_items(self, count=100):
+        return [{'model': 'app.model', 'pk': i, 'fields': {'name': u'item%s' % i}} for i in range(count)]
+    
+    def compress(self, items, **kwargs):
+        out_stream = BytesIO()
+        CompressDataTap(JSONDataTap(MemoryDataTap(items)), **kwargs).send(out_stream)
+        return out_stream.getvalue()
+    
+    def decompress(self, payload, **kwargs):
+        return list(JSONDataTap(CompressDataTap(StreamDataTap(BytesIO(payload)), chunk_size=64, **kwargs)))
+    
+    def assertRoundtrip(self, codec, **kwargs):
+        items = self.get_items()
+        payload = self.compress(items, codec=codec, **kwargs)
+        self.assertTrue(payload.startswith(CODECS[codec].magic))
+        self.assertEqual(self.decompress(payload), items)
+        return payload
+    
+    def test_gzip(self):
+        payload = self.assertRoundtrip('gzip', level=9)
+        json_stream = BytesIO()
+        JSONDataTap(MemoryDataTap(self.get_items())).send(json_stream)
+        self.assertEqual(gzip.GzipFile(fileobj=BytesIO(payload)).read(), json_stream.getvalue())
+        self.assertTrue(len(payload) < len(json_stream.getvalue()) / 4)
+    
+    def test_threaded_gzip(self):
+        payload = self.assertRoundtrip('gzip', threads=3, block_size=256)
+        self.assertTrue(payload.count(CODECS['gzip'].magic) > 3)
+        self.assertEqual(JSONDataTap(StreamDataTap(gzip.GzipFile(fileobj=BytesIO(payload)))).read(), self.get_items())
+    
+    def test_bz2(self):
+        payload = self.assertRoundtrip('bz2')
+        self.assertTrue(bz2.decompress(payload).startswith('['))
+        self.assertRoundtrip('bz2', threads=2, block_size=512)
+    
+    @unittest.skipIf(zstandard is None, 'zstandard is not installed')
+    def test_zstd(self):
+        self.assertRoundtrip('zstd', threads=2)
+    
+    @unittest.skipIf(lz4 is None, 'lz4 is not installed')
+    def test_lz4(self):
+        self.assertRoundtrip('lz4', threads=2, block_size=256)
+    
+    def test_detect_direction(self):
+        items = self.get_items(5)
+        payload = self.compress(items, codec='bz2')
+        self.assertEqual(self.decompress(payload), items)
+        self.assertEqual(self.decompress(payload, decompress=True, codec='bz2'), items)
+        self.assertRaises(ValueError, self.decompress, payload, codec='gzip')
+        #a stream of bytes is only compressed when asked to
+        json_stream = BytesIO()
+        JSONDataTap(MemoryDataTap(items)).send(json_stream)
+        self.assertRaises(ValueError, self.decompress, json_stream.getvalue())
+        tap = CompressDataTap(StreamDataTap(BytesIO(json_stream.getvalue())), decompress=False)
+        self.assertTrue(tap.read().startswith(CODECS['gzip'].magic))
+    
+    def test_command_line(self):
+        tap = CompressDataTap.load_from_command_line(['bz2', '--level', '1'], JSONDataTap(MemoryDataTap([1])))
+        self.assertEqual(tap.codec_name, 'bz2')
+        self.assertEqual(tap.level, 1)
+        tap = CompressDataTap.load_from_command_line_for_write(['--threads=4', 'gzip'], JSONDataTap(MemoryDataTap([1])))
+        self.assertEqual((tap.codec_name, tap.threads), ('gzip', 4))
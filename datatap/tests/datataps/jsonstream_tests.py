@@ -1,8 +1,12 @@
 from io import BytesIO
+import json
+import zipfile
 
 from django.utils import unittest
+from django.core.files.base import ContentFile
 
-from datatap.datataps import StreamDataTap, JSONDataTap, MemoryDataTap
+from datatap.datataps import StreamDataTap, JSONDataTap, NDJSONDataTap, MemoryDataTap, ZipFileDataTap
+from datatap.encoders import DataTapJSONEncoder
 
 
 class JSONDataTapTestCase(unittest.TestCase):
@@ -23,3 +27,107 @@ class JSONDataTapTestCase(unittest.TestCase):
         self.assertEqual(items[0], {'test1': 'item'})
         self.assertEqual(items[1], {'test2': 'item2'})
         tap.close()
+    
+    def test_decode_in_chunks(self):
+        payload = BytesIO('[{"test1": "item\xc3\xa9"}, 12345, {"test2": ["item2", null]}]')
+        source = StreamDataTap(payload)
+        tap = JSONDataTap(instream=source, chunk_size=3)
+        items = list(tap)
+        self.assertEqual(len(items), 3)
+        self.assertEqual(items[0], {'test1': u'item\xe9'})
+        self.assertEqual(items[1], 12345)
+        self.assertEqual(items[2], {'test2': ['item2', None]})
+        tap.close()
+    
+    def test_decode_numbers_across_chunks(self):
+        payload = '[1.5, 22, -3, 1e5, 2.5E-3 , 7]'
+        for chunk_size in range(1, len(payload) + 1):
+            tap = JSONDataTap(instream=StreamDataTap(BytesIO(payload)), chunk_size=chunk_size)
+            self.assertEqual(list(tap), [1.5, 22, -3, 1e5, 2.5E-3, 7])
+            tap.close()
+    
+    def test_decode_is_lazy(self):
+        payload = BytesIO('[{"test1": "item"}, {"test2": "item2"}, ' + ' ' * 1024 + '{"test3": "item3"}]')
+        source = StreamDataTap(payload)
+        tap = JSONDataTap(instream=source, chunk_size=32)
+        items = iter(tap)
+        self.assertEqual(next(items), {'test1': 'item'})
+        self.assertTrue(payload.tell() < 1024)
+        self.assertEqual(len(list(items)), 2)
+        tap.close()
+    
+    def test_encode_iterators_lazily(self):
+        consumed = list()
+        def rows():
+            for i in range(100):
+                consumed.append(i)
+                yield {'row': i}
+        source = MemoryDataTap([{'rows': rows(), 'empty': iter([])}])
+        tap = JSONDataTap(instream=source)
+        chunks = iter(tap)
+        for i in range(10):
+            next(chunks)
+        self.assertTrue(len(consumed) < 100)
+        ''.join(chunks)
+        self.assertEqual(len(consumed), 100)
+        tap.close()
+    
+    def test_encode_nested_iterators(self):
+        encoder = DataTapJSONEncoder()
+        payload = encoder.encode({'items': (i for i in range(3)), 'empty': iter([])})
+        self.assertEqual(json.loads(payload), {'items': [0, 1, 2], 'empty': []})
+        self.assertEqual(encoder.encode([{'rows': iter([1])}, {'rows': [2]}]), '[{"rows": [1]}, {"rows": [2]}]')
+    
+    def test_encode_writes_files_once(self):
+        written = list()
+        class FileTap(object):
+            def write_file(self, fileobj, path):
+                written.append(path)
+                return path
+        sample_file = ContentFile('Just some file, move along')
+        sample_file.name = 'readme.txt'
+        payload = DataTapJSONEncoder(filetap=FileTap()).encode([sample_file, iter([1, 2])])
+        self.assertEqual(json.loads(payload)[1], [1, 2])
+        self.assertEqual(written, ['readme.txt'])
+
+class NDJSONDataTapTestCase(unittest.TestCase):
+    def test_encode(self):
+        out_stream = BytesIO()
+        source = MemoryDataTap([{'test': 'item\nline'}, {'rows': (i for i in range(3))}])
+        tap = NDJSONDataTap(instream=source)
+        tap.send(out_stream)
+        tap.close()
+        self.assertEqual('{"test": "item\\nline"}\n{"rows": [0, 1, 2]}\n', out_stream.getvalue())
+    
+    def test_decode_in_chunks(self):
+        payload = BytesIO('{"test1": "item\xc3\xa9"}\n\n12345\n{"test2": ["item2", null]}')
+        tap = NDJSONDataTap(instream=StreamDataTap(payload), chunk_size=3)
+        items = list(tap)
+        self.assertEqual(items, [{'test1': u'item\xe9'}, 12345, {'test2': ['item2', None]}])
+        tap.close()
+    
+    def test_decode_long_lines(self):
+        rows = [{'text': u'x' * 5000}, {'text': u'y' * 3}]
+        payload = BytesIO(''.join(json.dumps(row) + '\n' for row in rows))
+        tap = NDJSONDataTap(instream=StreamDataTap(payload), chunk_size=7)
+        self.assertEqual(list(tap), rows)
+        tap.close()
+    
+    def test_split_lines(self):
+        out_stream = BytesIO()
+        NDJSONDataTap(instream=MemoryDataTap([{'row': i} for i in range(10)])).send(out_stream)
+        lines = out_stream.getvalue().splitlines(True)
+        first = list(NDJSONDataTap(instream=StreamDataTap(BytesIO(''.join(lines[:4])))))
+        rest = list(NDJSONDataTap(instream=StreamDataTap(BytesIO(''.join(lines[4:])))))
+        self.assertEqual(first + rest, [{'row': i} for i in range(10)])
+    
+    def test_zip_manifest(self):
+        sample_file = ContentFile('Just some file, move along')
+        sample_file.name = 'readme.txt'
+        archive_stream = BytesIO()
+        ZipFileDataTap(MemoryDataTap([{'readme': sample_file}]), manifest_format='NDJSON').send(archive_stream)
+        archive = zipfile.ZipFile(archive_stream)
+        self.assertEqual(json.loads(archive.read('manifest.ndjson'))['readme']['__type__'], 'File')
+        
+        items = list(ZipFileDataTap(StreamDataTap(archive_stream)))
+        self.assertEqual(items[0]['readme'].read(), 'Just some file, move along')
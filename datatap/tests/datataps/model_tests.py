@@ -1,8 +1,15 @@
+import threading
+
 from django.utils import unittest
+from django.db import IntegrityError, connection
+from django.db.models import signals
+from django.core.serializers.python import Serializer as PythonSerializer
 from django.contrib.contenttypes.models import ContentType
-from django.contrib.auth.models import Group
+from django.contrib.auth.models import Group, Permission, User
+from django.contrib.sites.models import Site
 
-from datatap.datataps import MemoryDataTap, ModelDataTap
+from datatap.datataps import MemoryDataTap, ModelDataTap, JSONDataTap
+from datatap.datataps.model import FileAwareSerializer, ParallelImport, UpsertQuery
 
 
 class ModelDataTapTestCase(unittest.TestCase):
@@ -30,4 +37,436 @@ class ModelDataTapTestCase(unittest.TestCase):
         self.assertTrue(items)
         self.assertEqual(len(items), ContentType.objects.all().count() + Group.objects.all().count())
         tap.close()
-
+    
+    def test_bulk_commit(self):
+        Group.objects.all().delete()
+        source = MemoryDataTap([{
+            'model': 'auth.group',
+            'pk': 100 + i,
+            'fields': {
+                'name': 'bulkgroup%s' % i,
+                'permissions': [],
+            }
+        } for i in range(50)])
+        tap = ModelDataTap(instream=source, commit_mode='bulk', batch_size=20)
+        batches = list(tap.get_commit_batches(iter(tap)))
+        self.assertEqual([(is_bulk, len(batch)) for is_bulk, batch in batches], [(True, 20), (True, 20), (True, 10)])
+        for is_bulk, batch in batches:
+            tap.save_batch(is_bulk, batch)
+        tap.close()
+        self.assertEqual(Group.objects.filter(name__startswith='bulkgroup').count(), 50)
+    
+    def test_bulk_commit_falls_back_for_m2m(self):
+        Group.objects.all().delete()
+        permission = Permission.objects.all()[0]
+        source = MemoryDataTap([{
+            'model': 'auth.group',
+            'pk': 5,
+            'fields': {'name': 'plain', 'permissions': []},
+        }, {
+            'model': 'auth.group',
+            'pk': 6,
+            'fields': {'name': 'withperms', 'permissions': [permission.pk]},
+        }])
+        tap = ModelDataTap(instream=source, use_natural_keys=False, commit_mode='bulk')
+        tap.commit()
+        tap.close()
+        self.assertEqual(Group.objects.get(pk=5).name, 'plain')
+        self.assertEqual(list(Group.objects.get(pk=6).permissions.all()), [permission])
+    
+    def get_duplicate_groups_source(self):
+        return MemoryDataTap([{
+            'model': 'auth.group',
+            'pk': 10 + i,
+            'fields': {'name': name, 'permissions': []},
+        } for i, name in enumerate(['first', 'second', 'first', 'third'])])
+    
+    def test_count_commit_policy_skips_failed_rows(self):
+        Group.objects.all().delete()
+        tap = ModelDataTap(instream=self.get_duplicate_groups_source(), commit_mode='bulk',
+                           commit_policy='count', commit_every=2)
+        tap.commit()
+        tap.close()
+        self.assertEqual(tap.failed_count, 1)
+        self.assertEqual(sorted(Group.objects.values_list('name', flat=True)), ['first', 'second', 'third'])
+    
+    def test_all_commit_policy_is_atomic(self):
+        Group.objects.all().delete()
+        tap = ModelDataTap(instream=self.get_duplicate_groups_source(), commit_policy='all')
+        self.assertRaises(IntegrityError, tap.commit)
+        tap.close()
+        self.assertFalse(Group.objects.exists())
+    
+    def get_groups_source(self, count):
+        return MemoryDataTap([{
+            'model': 'auth.group',
+            'pk': 100 + i,
+            'fields': {'name': 'group%s' % i, 'permissions': []},
+        } for i in range(count)])
+    
+    def test_uncommitted_flush(self):
+        Group.objects.all().delete()
+        tap = ModelDataTap(instream=self.get_groups_source(10), uncommitted_limit=3, uncommitted_overflow='flush')
+        items = list(tap)
+        self.assertEqual(len(items), 10)
+        self.assertEqual(Group.objects.count(), 9)
+        self.assertEqual(len(tap.deserialized_objects), 1)
+        tap.commit()
+        tap.close()
+        self.assertEqual(Group.objects.count(), 10)
+    
+    def test_uncommitted_spool(self):
+        Group.objects.all().delete()
+        tap = ModelDataTap(instream=self.get_groups_source(10), uncommitted_limit=3, uncommitted_overflow='spool')
+        items = list(tap)
+        self.assertEqual(len(items), 10)
+        self.assertFalse(Group.objects.exists())
+        self.assertEqual(len(tap.deserialized_objects), 10)
+        self.assertEqual(len(tap.deserialized_objects.objects), 3)
+        tap.commit()
+        tap.close()
+        self.assertEqual(sorted(Group.objects.values_list('name', flat=True)), sorted('group%s' % i for i in range(10)))
+    
+    def test_uncommitted_flush_is_not_atomic(self):
+        self.assertRaises(AssertionError, ModelDataTap, self.get_groups_source(10), commit_policy='all',
+                          uncommitted_limit=3, uncommitted_overflow='flush')
+        self.assertRaises(AssertionError, ModelDataTap, self.get_groups_source(10), fast_load=True, uncommitted_limit=3)
+    
+    def test_chunked_instance_stream(self):
+        Group.objects.all().delete()
+        for i in range(7):
+            Group.objects.create(name='chunk%s' % i)
+        pks = list(Group.objects.order_by('pk').values_list('pk', flat=True))
+        tap = ModelDataTap(instream=[Group], chunk_size=3)
+        items = list(tap)
+        self.assertEqual([item['pk'] for item in items], pks)
+        self.assertEqual(tap.last_keys, {'auth.group': pks[-1]})
+        tap.close()
+        
+        tap = ModelDataTap(instream=[Group.objects.all()], chunk_size=3, resume_keys={'auth.group': pks[2]})
+        self.assertEqual([item['pk'] for item in tap], pks[3:])
+        tap.close()
+    
+    def count_queries(self, func):
+        connection.use_debug_cursor = True
+        start = len(connection.queries)
+        try:
+            result = func()
+        finally:
+            connection.use_debug_cursor = None
+        return len(connection.queries) - start, result
+    
+    def test_natural_key_export_queries(self):
+        Group.objects.all().delete()
+        permissions = list(Permission.objects.all()[:5])
+        for i in range(10):
+            group = Group.objects.create(name='nk%s' % i)
+            group.permissions = permissions
+        expected = list(PythonSerializer().serialize(Group.objects.order_by('pk'), use_natural_keys=True))
+        
+        tap = ModelDataTap(instream=[Group], chunk_size=100)
+        num_queries, items = self.count_queries(lambda: list(tap))
+        tap.close()
+        self.assertEqual(items, expected)
+        #groups, prefetched permissions and the natural key of each distinct permission once
+        self.assertTrue(num_queries <= 2 + len(permissions), num_queries)
+        
+        #iterator() skips prefetch_related, the default path prefetches per batch
+        tap = ModelDataTap(instream=[Group.objects.order_by('pk')])
+        num_queries, items = self.count_queries(lambda: list(tap))
+        tap.close()
+        self.assertEqual(items, expected)
+        self.assertTrue(num_queries <= 2 + len(permissions), num_queries)
+        
+        tap = ModelDataTap(instream=[Permission], chunk_size=1000)
+        num_queries, items = self.count_queries(lambda: list(tap))
+        tap.close()
+        self.assertEqual(len(items), Permission.objects.count())
+        self.assertTrue(num_queries <= 2, num_queries)
+    
+    def test_natural_key_import_queries(self):
+        Group.objects.all().delete()
+        permissions = list(Permission.objects.all()[:20])
+        users = list()
+        for i in range(3):
+            user = User.objects.create(username='nkuser%s' % i)
+            users.append(user)
+        source = [{
+            'model': 'auth.group',
+            'pk': 200 + i,
+            'fields': {'name': 'nkgroup%s' % i, 'permissions': [p.natural_key() for p in permissions]},
+        } for i in range(30)]
+        source += [{
+            'model': 'admin.logentry',
+            'pk': 300 + i,
+            'fields': {
+                'action_time': '2013-01-01 00:00:00',
+                'user': users[i % 3].natural_key(),
+                'content_type': ['auth', 'group'],
+                'object_id': '1',
+                'object_repr': 'group',
+                'action_flag': 1,
+                'change_message': '',
+            },
+        } for i in range(30)]
+        #working out the natural keys of stream permissions would cost a query each
+        source += list(ModelDataTap(permissions))
+        
+        tap = ModelDataTap(instream=MemoryDataTap(source), track_uncommitted=False)
+        num_queries, items = self.count_queries(lambda: list(tap))
+        tap.close()
+        self.assertEqual(len(items), 80)
+        self.assertEqual(items[0].m2m_data['permissions'], [p.pk for p in permissions])
+        self.assertEqual([item.object.user_id for item in items[30:33]], [user.pk for user in users])
+        #permissions resolve one by one once, each looking up its content type
+        #once, users and content types are batched
+        self.assertTrue(num_queries <= len(permissions) + 10, num_queries)
+    
+    def test_natural_key_resolves_stream_objects(self):
+        User.objects.filter(username='streamuser').delete()
+        source = MemoryDataTap([{
+            'model': 'auth.user',
+            'pk': 500,
+            'fields': {'username': 'streamuser', 'password': '', 'date_joined': '2013-01-01 00:00:00', 'last_login': '2013-01-01 00:00:00'},
+        }, {
+            'model': 'admin.logentry',
+            'pk': 501,
+            'fields': {
+                'action_time': '2013-01-01 00:00:00',
+                'user': ['streamuser'],
+                'content_type': ['auth', 'group'],
+                'object_id': '1',
+                'object_repr': 'group',
+                'action_flag': 1,
+                'change_message': '',
+            },
+        }])
+        items = list(ModelDataTap(instream=source))
+        self.assertEqual(items[1].object.user_id, 500)
+    
+    def test_serialization_plan_matches_python_serializer(self):
+        user = User.objects.create(username='planuser', is_staff=True)
+        user.groups = Group.objects.all()[:2]
+        user.user_permissions = Permission.objects.all()[:3]
+        for use_natural_keys in (True, False):
+            for model in (User, Permission):
+                queryset = model.objects.order_by('pk')
+                expected = list(PythonSerializer().serialize(queryset, use_natural_keys=use_natural_keys))
+                items = list(FileAwareSerializer().serialize(queryset, use_natural_keys=use_natural_keys))
+                self.assertEqual(items, expected)
+        user.delete()
+    
+    def test_serialize_rows(self):
+        User.objects.create(username='rowuser', is_staff=True)
+        fields = ('username', 'is_staff', 'date_joined', 'last_login')
+        for queryset, options in ((ContentType.objects.order_by('pk'), {}),
+                                  (User.objects.order_by('pk'), {'fields': fields})):
+            expected = list(PythonSerializer().serialize(queryset, **dict(options)))
+            num_queries, items = self.count_queries(lambda: list(FileAwareSerializer().serialize_rows(queryset, **dict(options))))
+            self.assertEqual(items, expected)
+            self.assertEqual(num_queries, 1)
+        
+        #many to many fields need the instances
+        queryset = Group.objects.order_by('pk')
+        expected = list(PythonSerializer().serialize(queryset))
+        self.assertEqual(list(FileAwareSerializer().serialize_rows(queryset)), expected)
+        User.objects.filter(username='rowuser').delete()
+    
+    def test_raw_export(self):
+        user = User.objects.create(username='rawuser')
+        user.groups = Group.objects.all()[:1]
+        sources = [ContentType, User, Permission.objects.filter(content_type__app_label='auth')]
+        expected = JSONDataTap(ModelDataTap(list(sources))).read()
+        self.assertEqual(JSONDataTap(ModelDataTap(list(sources), raw_export=True)).read(), expected)
+        self.assertEqual(JSONDataTap(ModelDataTap(list(sources), raw_export=True, use_natural_keys=False)).read(),
+                         JSONDataTap(ModelDataTap(list(sources), use_natural_keys=False)).read())
+        
+        tap = ModelDataTap([ContentType], raw_export=True, chunk_size=2)
+        items = list(tap)
+        self.assertEqual(items, list(ModelDataTap([ContentType.objects.order_by('pk')])))
+        self.assertEqual(tap.last_keys, {'contenttypes.contenttype': items[-1]['pk']})
+        user.delete()
+    
+    def test_parallel_export(self):
+        expected = list(ModelDataTap([ContentType, Permission, Group, User]))
+        tap = ModelDataTap([User, Group, Permission, ContentType], workers=3)
+        self.assertEqual(list(tap), expected)
+        
+        #abandoning the export stops the workers
+        items = iter(ModelDataTap([Permission, ContentType], workers=2))
+        self.assertEqual(items.next(), expected[0])
+        items.close()
+        self.assertFalse(connection.allow_thread_sharing)
+    
+    def test_parallel_import(self):
+        Group.objects.filter(name__startswith='pgroup').delete()
+        User.objects.filter(username__startswith='puser').delete()
+        users = [{
+            'model': 'auth.user',
+            'pk': 600 + i,
+            'fields': {'username': 'puser%s' % i, 'password': '', 'groups': [600 + i],
+                       'date_joined': '2013-01-01 00:00:00', 'last_login': '2013-01-01 00:00:00'},
+        } for i in range(3)]
+        groups = [{
+            'model': 'auth.group',
+            'pk': 600 + i,
+            'fields': {'name': 'pgroup%s' % i, 'permissions': []},
+        } for i in range(3)]
+        content_types = list(ModelDataTap([ContentType]))
+        
+        saved_models = list()
+        class RecordingModelDataTap(ModelDataTap):
+            def commit_stream(self, deserialized_objects):
+                deserialized_objects = list(deserialized_objects)
+                saved_models.append(type(deserialized_objects[0].object))
+                return super(RecordingModelDataTap, self).commit_stream(deserialized_objects)
+        
+        tap = RecordingModelDataTap(MemoryDataTap(users + content_types + groups), workers=3)
+        tap.commit()
+        tap.close()
+        self.assertEqual(saved_models, [ContentType, Group, User])
+        self.assertEqual(User.objects.get(username='puser1').groups.get().name, 'pgroup1')
+        User.objects.filter(username__startswith='puser').delete()
+    
+    def test_parallel_import_runs_models_concurrently(self):
+        content_types = list(ModelDataTap(MemoryDataTap(list(ModelDataTap([ContentType])))))
+        permissions = list(ModelDataTap(MemoryDataTap(list(ModelDataTap([Permission])))))
+        sites = list(ModelDataTap(MemoryDataTap(list(ModelDataTap([Site])))))
+        
+        events = list()
+        site_started = threading.Event()
+        class RecordingModelDataTap(ModelDataTap):
+            def commit_stream(self, deserialized_objects):
+                model = type(list(deserialized_objects)[0].object)
+                events.append(('start', model))
+                if model is Site:
+                    site_started.set()
+                elif model is ContentType:
+                    #only set if sites are saved meanwhile
+                    events.append(('concurrent', site_started.wait(5)))
+                events.append(('done', model))
+        
+        tap = RecordingModelDataTap(MemoryDataTap([]), uncommitted_limit=5)
+        importer = ParallelImport(tap, content_types + permissions + sites, 3)
+        #the journal keeps 5 objects of a model in memory, the rest on disk
+        self.assertEqual(len(importer.groups[Permission].objects), 5)
+        self.assertEqual(len(importer.groups[Permission]), len(permissions))
+        #in memory sqlite forces one worker, the scheduling is tested on three
+        importer.workers = 3
+        importer.run()
+        self.assertTrue(('concurrent', True) in events)
+        self.assertTrue(events.index(('start', Permission)) > events.index(('done', ContentType)))
+    
+    def test_parallel_import_is_not_atomic(self):
+        self.assertRaises(AssertionError, ModelDataTap, MemoryDataTap([]), workers=2, commit_policy='all')
+    
+    def test_fast_load(self):
+        Group.objects.filter(name__startswith='fgroup').delete()
+        permissions = list(Permission.objects.values_list('pk', flat=True)[:2])
+        source = MemoryDataTap([{
+            'model': 'auth.group',
+            'pk': 700 + i,
+            'fields': {'name': 'fgroup%s' % i, 'permissions': permissions},
+        } for i in range(3)])
+        sent = list()
+        def receiver(sender, **kwargs):
+            sent.append(sender)
+        signals.pre_save.connect(receiver)
+        signals.post_save.connect(receiver)
+        signals.m2m_changed.connect(receiver)
+        try:
+            tap = ModelDataTap(source, fast_load=True)
+            tap.commit()
+            tap.close()
+        finally:
+            signals.pre_save.disconnect(receiver)
+            signals.post_save.disconnect(receiver)
+            signals.m2m_changed.disconnect(receiver)
+        self.assertEqual(sent, [])
+        group = Group.objects.get(name='fgroup1')
+        self.assertEqual(sorted(group.permissions.values_list('pk', flat=True)), sorted(permissions))
+        
+        #reloading replaces the many to many rows
+        tap = ModelDataTap(MemoryDataTap([{
+            'model': 'auth.group',
+            'pk': group.pk,
+            'fields': {'name': 'fgroup1', 'permissions': permissions[:1]},
+        }]), fast_load=True)
+        tap.commit()
+        tap.close()
+        self.assertEqual(list(group.permissions.values_list('pk', flat=True)), permissions[:1])
+        Group.objects.filter(name__startswith='fgroup').delete()
+    
+    def test_fast_load_is_atomic(self):
+        self.assertRaises(AssertionError, ModelDataTap, MemoryDataTap([]), fast_load=True, commit_policy='object')
+        self.assertEqual(ModelDataTap(MemoryDataTap([]), fast_load=True).commit_policy, 'all')
+        Group.objects.filter(name__startswith='fgroup').delete()
+        source = MemoryDataTap([{
+            'model': 'auth.group',
+            'pk': 710 + i,
+            'fields': {'name': 'fgroup%s' % i, 'permissions': [99999] if i == 2 else []},
+        } for i in range(3)])
+        tap = ModelDataTap(source, fast_load=True)
+        self.assertRaises(IntegrityError, tap.commit)
+        tap.close()
+        self.assertFalse(Group.objects.filter(name__startswith='fgroup').exists())
+    
+    def test_upsert_commit(self):
+        Group.objects.filter(pk__gte=800).delete()
+        Group.objects.create(pk=800, name='ugroup0')
+        Group.objects.create(pk=801, name='ugroup1')
+        source = [{
+            'model': 'auth.group',
+            'pk': 800 + i,
+            'fields': {'name': 'ugroup%s-new' % i if i == 1 else 'ugroup%s' % i, 'permissions': []},
+        } for i in range(4)]
+        tap = ModelDataTap(MemoryDataTap(source), commit_mode='upsert', commit_policy='all')
+        num_queries, result = self.count_queries(tap.commit)
+        tap.close()
+        self.assertEqual(num_queries, 1)
+        self.assertEqual(list(Group.objects.filter(pk__gte=800).order_by('pk').values_list('name', flat=True)),
+                         ['ugroup0', 'ugroup1-new', 'ugroup2', 'ugroup3'])
+        
+        source[3]['fields']['name'] = 'ugroup3-new'
+        tap = ModelDataTap(MemoryDataTap(source), commit_mode='upsert', commit_policy='all', skip_unchanged=True)
+        tap.commit()
+        tap.close()
+        self.assertEqual(tap.skipped_count, 3)
+        self.assertEqual(Group.objects.get(pk=803).name, 'ugroup3-new')
+        Group.objects.filter(pk__gte=800).delete()
+    
+    def test_upsert_natural_key(self):
+        permission = Permission.objects.all()[0]
+        items = list(ModelDataTap([Permission.objects.filter(pk=permission.pk)]))
+        items[0]['pk'] = 9999
+        items[0]['fields']['name'] = 'renamed'
+        count = Permission.objects.count()
+        tap = ModelDataTap(MemoryDataTap(items), commit_mode='upsert', upsert_key='natural')
+        tap.commit()
+        tap.close()
+        self.assertEqual(Permission.objects.count(), count)
+        self.assertEqual(Permission.objects.get(pk=permission.pk).name, 'renamed')
+        Permission.objects.filter(pk=permission.pk).update(name=permission.name)
+    
+    def test_upsert_natural_key_saved_one_by_one(self):
+        permission = Permission.objects.all()[0]
+        items = list(ModelDataTap([Permission.objects.filter(pk=permission.pk)]))
+        items[0]['pk'] = 9999
+        items[0]['fields']['name'] = 'renamed'
+        count = Permission.objects.count()
+        tap = ModelDataTap(MemoryDataTap(items), commit_mode='upsert', upsert_key='natural')
+        tap.is_bulk_model = lambda model: False
+        tap.commit()
+        tap.close()
+        self.assertEqual(Permission.objects.count(), count)
+        self.assertEqual(Permission.objects.get(pk=permission.pk).name, 'renamed')
+        Permission.objects.filter(pk=permission.pk).update(name=permission.name)
+    
+    def test_upsert_mysql_unique_keys(self):
+        class MySQLConnection(object):
+            vendor = 'mysql'
+            ops = connection.ops
+        #the unique name of a group would be matched as well as its primary key
+        self.assertTrue(UpsertQuery(Group, MySQLConnection(), 'pk').has_other_unique_keys())
+        self.assertFalse(UpsertQuery(Permission, MySQLConnection(), 'natural').has_other_unique_keys())
+        self.assertFalse(UpsertQuery(Group, connection, 'pk').has_other_unique_keys())
@@ -0,0 +1,134 @@
+import io
+import json
+import zipfile
+import threading
+
+from django.utils import unittest
+
+from datatap.datataps import MemoryDataTap, StreamDataTap, ZipFileDataTap
+from datatap.datataps.s3bucket import S3Upload, S3RangedFile, MIN_PART_SIZE
+
+
+class StubMultiPartUpload(object):
+    def __init__(self, bucket, key_name):
+        self.bucket = bucket
+        self.key_name = key_name
+        self.parts = dict()
+        self.lock = threading.Lock()
+    
+    def upload_part_from_file(self, fp, part_num):
+        with self.lock:
+            self.parts[part_num] = fp.read()
+    
+    def complete_upload(self):
+        self.bucket.contents[self.key_name] = ''.join(self.parts[i] for i in sorted(self.parts))
+    
+    def cancel_upload(self):
+        self.bucket.cancelled.append(self.key_name)
+
+class StubBucket(object):
+    def __init__(self):
+        self.contents = dict()
+        self.cancelled = list()
+        self.uploads = list()
+    
+    def initiate_multipart_upload(self, key_name):
+        upload = StubMultiPartUpload(self, key_name)
+        self.uploads.append(upload)
+        return upload
+
+class StubKey(object):
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+    
+    def set_contents_from_string(self, payload):
+        self.bucket.contents[self.name] = payload
+
+class StubRangedKey(object):
+    def __init__(self, payload):
+        self.payload = payload
+        self.size = len(payload)
+        self.requests = list()
+    
+    def get_contents_as_string(self, headers):
+        start, end = headers['Range'][len('bytes='):].split('-')
+        self.requests.append((int(start), int(end)))
+        return self.payload[int(start):int(end) + 1]
+
+class S3UploadTestCase(unittest.TestCase):
+    def test_multipart_upload(self):
+        bucket = StubBucket()
+        upload = S3Upload(StubKey(bucket, 'export.json'), part_size=MIN_PART_SIZE, concurrency=2)
+        chunks = [chr(ord('a') + i) * (1024 * 1024) for i in range(12)]
+        for chunk in chunks:
+            upload.write(chunk)
+        self.assertEqual(upload.tell(), 12 * 1024 * 1024)
+        upload.close()
+        
+        self.assertEqual(bucket.contents['export.json'], ''.join(chunks))
+        self.assertEqual(len(bucket.uploads[0].parts), 3)
+        self.assertTrue(all(len(part) == MIN_PART_SIZE for num, part in bucket.uploads[0].parts.items() if num < 3))
+    
+    def test_part_size_too_small(self):
+        self.assertRaises(AssertionError, S3Upload, StubKey(StubBucket(), 'export.json'), part_size=1024)
+    
+    def test_small_upload(self):
+        bucket = StubBucket()
+        upload = S3Upload(StubKey(bucket, 'export.json'))
+        upload.write('[]')
+        upload.close()
+        self.assertEqual(bucket.contents['export.json'], '[]')
+        self.assertEqual(bucket.uploads, [])
+    
+    def test_cancel_on_error(self):
+        bucket = StubBucket()
+        def fail(fp, part_num):
+            raise IOError('connection reset')
+        upload = S3Upload(StubKey(bucket, 'export.json'), part_size=MIN_PART_SIZE, concurrency=1)
+        upload.write('1' * MIN_PART_SIZE * 2)
+        bucket.uploads[0].upload_part_from_file = fail
+        upload.write('90')
+        self.assertRaises(IOError, upload.close)
+        self.assertEqual(bucket.cancelled, ['export.json'])
+        self.assertFalse('export.json' in bucket.contents)
+
+class S3RangedFileTestCase(unittest.TestCase):
+    def test_read_and_seek(self):
+        key = StubRangedKey('0123456789' * 10)
+        fileobj = S3RangedFile(key, block_size=16)
+        self.assertEqual(fileobj.read(4), '0123')
+        self.assertEqual(fileobj.read(4), '4567')
+        self.assertEqual(len(key.requests), 1)
+        fileobj.seek(-5, 2)
+        self.assertEqual(fileobj.read(), '56789')
+        self.assertEqual(fileobj.read(), '')
+        fileobj.seek(3)
+        self.assertEqual(fileobj.tell(), 3)
+        self.assertEqual(fileobj.read(40), ('0123456789' * 5)[3:43])
+        fileobj.seek(14)
+        self.assertEqual(fileobj.read(4), '4567')
+    
+    def test_interleaved_reads(self):
+        payload = ''.join(chr(i % 256) for i in range(4096))
+        key = StubRangedKey(payload)
+        fileobj = S3RangedFile(key, block_size=256, cached_blocks=2)
+        for offset in range(0, 256, 32):
+            for region in (0, 2048):
+                fileobj.seek(region + offset)
+                self.assertEqual(fileobj.read(32), payload[region + offset:region + offset + 32])
+        self.assertEqual(len(key.requests), 2)
+    
+    def test_zip_reads_only_what_it_needs(self):
+        archive_stream = io.BytesIO()
+        archive = zipfile.ZipFile(archive_stream, 'w')
+        archive.writestr('manifest.json', json.dumps([{'field1': 'value1'}]))
+        archive.writestr('assets/large.bin', 'x' * 1024 * 1024)
+        archive.close()
+        
+        key = StubRangedKey(archive_stream.getvalue())
+        tap = MemoryDataTap(ZipFileDataTap(StreamDataTap(S3RangedFile(key, block_size=4096))))
+        result = list(tap)
+        self.assertEqual(result, [{'field1': 'value1'}])
+        fetched = sum(end - start + 1 for start, end in key.requests)
+        self.assertTrue(fetched < 64 * 1024)
@@ -15,6 +15,16 @@ class ContentFile(BaseContentFile): #for ease with Django 1.3
         super(ContentFile, self).__init__(content)
         self.name = name
 
+class ForwardOnlyStream(object):
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+    
+    def read(self, size=-1):
+        return self.fileobj.read(size)
+    
+    def write(self, data):
+        return self.fileobj.write(data)
+
 class TarFileDataTapTestCase(unittest.TestCase):
     def test_store(self):
         instream = MemoryDataTap([{
@@ -70,6 +80,21 @@ class TarFileDataTapTestCase(unittest.TestCase):
         readme = archive.extractfile('readme.txt').read()
         self.assertEqual(readme, 'Just some file, move along')
     
+    def test_store_with_large_file(self):
+        content = 'x' * (256 * 1024 + 7)
+        payload = [{
+            'test':'item',
+            'readme':ContentFile(content, 'large.txt'),
+        }]
+        tartap = TarFileDataTap(MemoryDataTap(payload))
+        archive_stream = io.BytesIO()
+        tartap.send(archive_stream)
+        
+        archive_stream.seek(0)
+        archive = tarfile.TarFile(fileobj=archive_stream)
+        self.assertEqual(archive.getmember('large.txt').size, len(content))
+        self.assertEqual(archive.extractfile('large.txt').read(), content)
+    
     def test_load_with_file(self):
         archive_stream = io.BytesIO()
         
@@ -113,3 +138,54 @@ class TarFileDataTapTestCase(unittest.TestCase):
         assert result
         
         tap.close()
+    
+    def test_stream_roundtrip(self):
+        payload = [{
+            'test':'item%s' % i,
+            'readme':ContentFile('readme %s' % i, 'readme%s.txt' % i),
+        } for i in range(5)]
+        tartap = TarFileDataTap(MemoryDataTap(payload), compression='gz', stream=True, batch_size=2)
+        archive_stream = io.BytesIO()
+        tartap.send(ForwardOnlyStream(archive_stream))
+        
+        archive_stream.seek(0)
+        archive = tarfile.open(fileobj=archive_stream, mode='r:gz')
+        self.assertEqual(archive.getnames(), [
+            'manifest-000000.json', 'readme0.txt', 'readme1.txt',
+            'manifest-000001.json', 'readme2.txt', 'readme3.txt',
+            'manifest-000002.json', 'readme4.txt',
+        ])
+        
+        archive_stream.seek(0)
+        tap = TarFileDataTap(StreamDataTap(ForwardOnlyStream(archive_stream)), compression='gz', stream=True)
+        items = list(tap)
+        self.assertEqual(len(items), 5)
+        for i, item in enumerate(items):
+            self.assertEqual(item['test'], 'item%s' % i)
+            self.assertTrue(isinstance(item['readme'], File))
+            self.assertEqual(item['readme'].read(), 'readme %s' % i)
+        tap.close()
+    
+    def test_stream_reads_assets_lazily(self):
+        payload = [{
+            'index': i,
+            'readme': ContentFile(str(i) * 100000, 'readme%s.txt' % i),
+            'notes': ContentFile('notes %s' % i, 'manifest-notes%s.json' % i),
+        } for i in range(4)]
+        archive_stream = io.BytesIO()
+        TarFileDataTap(MemoryDataTap(payload), stream=True, batch_size=2).send(archive_stream)
+        
+        archive_stream.seek(0)
+        items = iter(TarFileDataTap(StreamDataTap(ForwardOnlyStream(archive_stream)), stream=True))
+        first = next(items)
+        #the records of a part come before its assets are read
+        self.assertTrue(archive_stream.tell() < 100000)
+        self.assertEqual(first['notes'].read(), 'notes 0')
+        second = next(items)
+        self.assertEqual(second['readme'].read(), '1' * 100000)
+        self.assertEqual(second['readme'].size, 100000)
+        #unread assets are kept once the next part is reached
+        rest = list(items)
+        self.assertEqual(first['readme'].read(), '0' * 100000)
+        self.assertEqual([item['index'] for item in rest], [2, 3])
+        self.assertEqual(rest[1]['notes'].read(), 'notes 3')
@@ -1,12 +1,14 @@
 import zipfile
 import json
 import io
+from optparse import OptionParser, OptionValueError
 
 from django.utils import unittest
 from django.core.files.base import File, ContentFile as BaseContentFile
 from django.core.files.storage import DefaultStorage
 
 from datatap.datataps import MemoryDataTap, StreamDataTap, ZipFileDataTap
+from datatap.datataps.zip import WritableZipExtFile
 
 
 class ContentFile(BaseContentFile): #for ease with Django 1.3
@@ -58,6 +60,41 @@ class ZipFileDataTapTestCase(unittest.TestCase):
         readme = archive.read('readme.txt')
         self.assertEqual(readme, 'Just some file, move along')
     
+    def test_store_many_with_files(self):
+        payload = [{
+            'test': 'item%s' % i,
+            'readme': ContentFile('readme %s' % i, 'readme%s.txt' % i),
+        } for i in range(5)]
+        ziptap = ZipFileDataTap(MemoryDataTap(payload))
+        archive_stream = io.BytesIO()
+        ziptap.send(archive_stream)
+        
+        archive = zipfile.ZipFile(archive_stream, 'r')
+        self.assertEqual(archive.testzip(), None)
+        self.assertEqual(archive.namelist()[0], 'manifest.json')
+        manifest = json.loads(archive.read('manifest.json'))
+        self.assertEqual(len(manifest), 5)
+        self.assertEqual(archive.read('readme3.txt'), 'readme 3')
+    
+    def test_writable_zip_ext_file(self):
+        archive_stream = io.BytesIO()
+        archive = zipfile.ZipFile(archive_stream, 'w')
+        entry = WritableZipExtFile(archive, 'stored.txt')
+        entry.write('stored ')
+        entry.write(u'text')
+        entry.close()
+        entry = WritableZipExtFile(archive, 'deflated.txt', zipfile.ZIP_DEFLATED)
+        for i in range(100):
+            entry.write('deflated text ')
+        entry.close()
+        archive.close()
+        
+        archive = zipfile.ZipFile(archive_stream, 'r')
+        self.assertEqual(archive.testzip(), None)
+        self.assertEqual(archive.read('stored.txt'), 'stored text')
+        self.assertEqual(archive.read('deflated.txt'), 'deflated text ' * 100)
+        self.assertTrue(archive.getinfo('deflated.txt').compress_size < 100)
+    
     def test_load_with_file(self):
         archive_stream = io.BytesIO()
         
@@ -99,3 +136,85 @@ class ZipFileDataTapTestCase(unittest.TestCase):
         assert result
         
         tap.close()
+    
+    def test_load_interleaved_with_large_manifest(self):
+        archive_stream = io.BytesIO()
+        archive = zipfile.ZipFile(archive_stream, 'w')
+        in_stream = list()
+        for i in range(2000):
+            path = 'assets/readme%s.txt' % i
+            in_stream.append({'index': i, 'readme': {'__type__':'File', 'storage_path':path, 'path':path}})
+            archive.writestr(path, 'readme %s' % i)
+        archive.writestr('manifest.json', json.dumps(in_stream))
+        archive.close()
+        
+        tap = ZipFileDataTap(StreamDataTap(archive_stream))
+        count = 0
+        for item in tap:
+            #reading assets must not disturb the manifest being decoded
+            self.assertEqual(item['readme'].read(), 'readme %s' % item['index'])
+            count += 1
+        self.assertEqual(count, 2000)
+        tap.close()
+    
+    def test_lazy_file_seek(self):
+        archive_stream = io.BytesIO()
+        archive = zipfile.ZipFile(archive_stream, 'w', zipfile.ZIP_DEFLATED)
+        archive.writestr('manifest.json', json.dumps([{'readme': {'__type__':'File', 'storage_path':'readme.txt', 'path':'readme.txt'}}]))
+        archive.writestr('readme.txt', '0123456789')
+        archive.close()
+        
+        items = list(ZipFileDataTap(StreamDataTap(archive_stream)))
+        readme = items[0]['readme']
+        self.assertEqual(readme.size, 10)
+        self.assertEqual(readme.read(4), '0123')
+        readme.seek(8)
+        self.assertEqual(readme.read(), '89')
+        readme.seek(2)
+        self.assertEqual(readme.tell(), 2)
+        self.assertEqual(readme.read(3), '234')
+        self.assertEqual(''.join(readme.chunks()), '0123456789')
+        readme.close()
+    
+    def test_compression_policy(self):
+        payload = [{
+            'readme': ContentFile('text compresses well ' * 100, 'readme.txt'),
+            'photo': ContentFile('\xff\xd8' + 'jpeg data ' * 100, 'photo.jpg'),
+            'clip': ContentFile('mp4 data ' * 100, 'clip.MP4'),
+        }]
+        archive_stream = io.BytesIO()
+        ZipFileDataTap(MemoryDataTap(payload), compression_level=9).send(archive_stream)
+        archive = zipfile.ZipFile(archive_stream)
+        self.assertEqual(archive.testzip(), None)
+        self.assertEqual(archive.getinfo('manifest.json').compress_type, zipfile.ZIP_DEFLATED)
+        self.assertEqual(archive.getinfo('readme.txt').compress_type, zipfile.ZIP_DEFLATED)
+        self.assertEqual(archive.getinfo('photo.jpg').compress_type, zipfile.ZIP_STORED)
+        self.assertEqual(archive.getinfo('clip.MP4').compress_type, zipfile.ZIP_STORED)
+        self.assertEqual(archive.read('readme.txt'), 'text compresses well ' * 100)
+        
+        items = list(ZipFileDataTap(StreamDataTap(archive_stream)))
+        self.assertEqual(items[0]['photo'].read(), '\xff\xd8' + 'jpeg data ' * 100)
+    
+    def test_compression_options(self):
+        payload = [{'readme': ContentFile('text', 'readme.txt'), 'photo': ContentFile('jpeg', 'photo.jpg')}]
+        tap = ZipFileDataTap.load_from_command_line(['--manifest-compression=store', '--store-extensions=txt, .csv'],
+                                                    MemoryDataTap(payload))
+        archive_stream = io.BytesIO()
+        tap.send(archive_stream)
+        archive = zipfile.ZipFile(archive_stream)
+        self.assertEqual(archive.getinfo('manifest.json').compress_type, zipfile.ZIP_STORED)
+        self.assertEqual(archive.getinfo('readme.txt').compress_type, zipfile.ZIP_STORED)
+        self.assertEqual(archive.getinfo('photo.jpg').compress_type, zipfile.ZIP_DEFLATED)
+        
+        archive_stream = io.BytesIO()
+        ZipFileDataTap(MemoryDataTap(payload), compression='store').send(archive_stream)
+        archive = zipfile.ZipFile(archive_stream)
+        self.assertEqual(archive.getinfo('readme.txt').compress_type, zipfile.ZIP_STORED)
+    
+    def test_compression_level(self):
+        tap = ZipFileDataTap.load_from_command_line(['--compression-level=-1'], MemoryDataTap([]))
+        self.assertEqual(tap.compression_level, -1)
+        self.assertRaises(AssertionError, ZipFileDataTap, MemoryDataTap([]), compression_level=10)
+        parser = OptionParser(option_list=ZipFileDataTap.command_option_list)
+        self.assertRaises(OptionValueError, parser.get_option('--compression-level').check_value,
+                          '--compression-level', '10')
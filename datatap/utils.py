@@ -0,0 +1,33 @@
+try:
+    from collections import OrderedDict
+except ImportError: #python 2.6
+    from django.utils.datastructures import SortedDict as OrderedDict
+
+
+class LRUCache(object):
+    '''
+    A mapping holding at most `size` entries, the least recently used entry
+    is evicted first
+    '''
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+    
+    def __contains__(self, key):
+        return key in self.entries
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def get(self, key, default=None):
+        if key not in self.entries:
+            return default
+        value = self.entries.pop(key)
+        self.entries[key] = value
+        return value
+    
+    def __setitem__(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        if len(self.entries) > self.size:
+            del self.entries[iter(self.entries).next()]